@@ -12,6 +12,7 @@ from experiment.background.agent import (
     GeneticSimpleAgent,
 )
 from experiment.util.config import logger
+from experiment.util.instrument import INSTRUMENTS
 
 
 class Evolution(object):
@@ -44,143 +45,159 @@ class Evolution(object):
             + f"Mutation-bitwise: {self.mutation_bitwise_rate}"
         )
 
-    def evolve(self, population, evaluation):
+    def evolve(self, population, evaluation, scored=None):
+        """Next generation of ``population``.
+
+        Args:
+            scored (list): Optional number of stocks each agent was scored on, see
+                ``Market.race``. Agents scored on more stocks are then selected
+                first, and ``evaluation`` only orders agents scored on as many.
+        """
+        with INSTRUMENTS.timer("evolution.evolve"):
+            return self._evolve(population, evaluation, scored)
+
+    def _evolve(self, population, evaluation, scored):
         assert len(population) == len(evaluation)
         logger.info(f"Evolution started.")
-        res = self._evolve_zipped(list(zip(population, evaluation)))
+        agent_class = type(population[0])
+        genes, params = agent_class.to_matrix(population)
+        source, genes, params = self._evolve_matrix(
+            genes, params, np.asarray(evaluation), agent_class.RULES, scored
+        )
+        # Agents passed on unchanged are reused, only new genomes become new agents.
+        new = iter(
+            agent_class.from_matrix(
+                genes[source < 0], None if params is None else params[source < 0]
+            )
+        )
+        res = [population[i] if i >= 0 else next(new) for i in source]
         assert len(population) == len(res)
         logger.info(f"Evolution completed.")
         return res
 
-    def _evolve_zipped(self, population):
-        original_num = len(population)
-        survived = self._select(population, self.survival_rate)
-        elite = self._select(population, self.elitism_rate)
-        parents, non_parents = self._split_survived(survived)
-        to_mutate = non_parents + self._crossover(
-            parents, original_num - len(non_parents) - len(elite)
+    def evolve_matrix(
+        self, genes, evaluation, params=None, rules=GeneticAgent.RULES, scored=None
+    ):
+        """``evolve`` on a gene matrix with one row per agent, and for
+        ``ComplexEvolution`` the matching param matrix (see ``GeneticAgent.to_matrix``).
+
+        Returns:
+            tuple: The next generation's gene matrix and param matrix.
+        """
+        assert len(genes) == len(evaluation)
+        _, genes, params = self._evolve_matrix(
+            np.asarray(genes), params, np.asarray(evaluation), rules, scored
         )
-        next_gen = elite + self._mutate(to_mutate)
-        assert len(next_gen) == original_num
-        return next_gen
+        return genes, params
+
+    def _evolve_matrix(self, genes, params, evaluation, rules, scored=None):
+        """Selection, crossover and mutation as whole-matrix operations.
+
+        Returns:
+            tuple: #1 is, for each row of the next generation, the row of ``genes``
+            it copies unchanged or -1 if it is new, #2 and #3 the next gene and
+            param matrices.
+        """
+        original_num = len(evaluation)
+        # Stable, so ties keep their order like ``sorted(..., reverse=True)``.
+        if scored is None:
+            order = np.argsort(-evaluation, kind="stable")
+        else:
+            order = np.lexsort((-evaluation, -np.asarray(scored)))
+        survived = order[: int(original_num * self.survival_rate)]
+        elite = order[: int(original_num * self.elitism_rate)]
+        parents, non_parents = self._split_survived(survived)
+        target_num = original_num - len(non_parents) - len(elite)
+        children = self._crossover(genes, params, rules, parents, target_num)
+        source = np.concatenate([non_parents, np.full(len(children[0]), -1)])
+        to_mutate = [source, np.concatenate([genes[non_parents], children[0]])]
+        if params is not None:
+            to_mutate.append(np.concatenate([params[non_parents], children[1]]))
+        source, genes_next, *params_next = self._mutate(to_mutate, rules)
+
+        source = np.concatenate([elite, source])
+        genes_next = np.concatenate([genes[elite], genes_next])
+        if params is not None:
+            params_next = np.concatenate([params[elite], params_next[0]])
+        else:
+            params_next = None
+        assert len(source) == original_num
+        return source, genes_next, params_next
 
     def _split_survived(self, survived):
         """Split the survived agents into crossover parents and those who goes to the next generation directly.
         Args:
-            survived (list): list of agents
+            survived (np.ndarray): rows of the survived agents
 
         Returns:
             tuple: #1 is the crossover parents and #2 shall go to the next generation.
         """
-        arr = list(np.random.permutation(survived))
+        arr = np.random.permutation(survived)
         point = int(len(arr) * self.crossover_rate)
         return arr[:point], arr[point:]
 
-    def _select(self, population, rate):
-        return [
-            pair[0]
-            for pair in sorted(population, reverse=True, key=lambda x: x[1])[
-                : int(len(population) * rate)
-            ]
-        ]
-
-    def _crossover(self, parents, target_num):
+    def _crossover(self, genes, params, rules, parents, target_num):
         assert len(parents) >= 2
-
+        # Two distinct parents per child, then each rule from either one.
+        first = np.random.randint(0, len(parents), target_num)
+        second = np.random.randint(0, len(parents) - 1, target_num)
+        second += second >= first
+        p1, p2 = parents[first], parents[second]
+        choice = np.random.random((target_num, genes.shape[1])) < 0.5
+        child_genes = np.where(choice, genes[p2], genes[p1])
+        if params is None:
+            return child_genes, None
+        choice = np.repeat(choice, _param_sizes(rules), axis=1)
+        return child_genes, np.where(choice, params[p2], params[p1])
+
+    def _mutate(self, matrices, rules):
+        order = np.random.permutation(len(matrices[0]))
+        matrices = [matrix[order] for matrix in matrices]
+        point = int(len(order) * self.mutation_rate)
+        genes = matrices[1]
+        keep = np.random.uniform(size=(point, genes.shape[1]))
+        keep = keep < self.mutation_bitwise_rate
+        mutated = [np.full(point, -1), self._mutate_genes(genes[:point], keep)]
+        if len(matrices) > 2:
+            mutated.append(self._mutate_params(matrices[2][:point], keep, rules))
+        # Kept agents first, then the mutated ones.
         return [
-            self._crossover_inner(*np.random.choice(parents, 2, replace=False))
-            for _ in range(target_num)
+            np.concatenate([matrix[point:], new])
+            for matrix, new in zip(matrices, mutated)
         ]
 
-    def _mutate(self, agents):
-        agents = list(np.random.permutation(agents))
-        point = int(len(agents) * self.mutation_rate)
-        mutate, keep = agents[:point], agents[point:]
-        return keep + [self._mutate_agent(agent) for agent in mutate]
+    def _mutate_genes(self, genes, keep):
+        raise NotImplementedError
 
 
 class SimpleEvolution(Evolution):
-    def _crossover_inner(self, p1, p2):
-        assert type(p1) == type(p2)
-        g1, g2 = p1.gene, p2.gene
-        new_agent = p1.__class__(
-            [(g1[i] if np.random.randint(0, 2) == 0 else g2[i]) for i in range(len(g1))]
-        )
-        logger.debug(
-            f"Crossover of agents with gene '{g1}' and '{g2}' produces new agent with gene '{new_agent.gene}'."
-        )
-        return new_agent
+    pass
 
 
 class BitEvolution(SimpleEvolution):
-    def _mutate_agent(self, agent):
-        new_agent = agent.__class__(
-            [
-                (
-                    bit
-                    if np.random.uniform() < self.mutation_bitwise_rate
-                    else np.random.randint(0, 2)
-                )
-                for bit in agent.gene
-            ]
-        )
-        logger.debug(
-            f"Mutating agent's gene from '{agent.gene}' to '{new_agent.gene}' "
-        )
-        return new_agent
+    def _mutate_genes(self, genes, keep):
+        return np.where(keep, genes, np.random.randint(0, 2, genes.shape))
 
 
 class RealEvolution(SimpleEvolution):
-    def _mutate_agent(self, agent):
-        new_agent = agent.__class__(
-            [
-                (
-                    real
-                    if np.random.uniform() < self.mutation_bitwise_rate
-                    else np.random.uniform()
-                )
-                for real in agent.gene
-            ]
-        )
-        logger.debug(
-            f"Mutating agent's gene from '{agent.gene}' to '{new_agent.gene}' "
-        )
-        return new_agent
+    def _mutate_genes(self, genes, keep):
+        return np.where(keep, genes, np.random.uniform(size=genes.shape))
 
 
 class ComplexEvolution(Evolution):
-    def _crossover_inner(self, p1, p2):
-        assert type(p1) == type(p2)
-        gene1, gene2 = p1.gene, p2.gene
-        param1, param2 = p1.param_gene, p2.param_gene
-        assert len(gene1) == len(gene2) == len(param1) == len(param2)
-
-        choice = np.random.randint(0, 2, len(gene1))
-        new_agent = p1.__class__(
-            [(gene1[i] if choice[i] == 0 else gene2[i]) for i in range(len(choice))],
-            [(param1[i] if choice[i] == 0 else param2[i]) for i in range(len(choice))],
-        )
-        logger.debug(
-            f"Crossover of agents with gene '{gene1}', '{param1}' and '{gene2}', '{param2}' produces new agent with gene '{new_agent.gene}', '{new_agent.param_gene}'."
-        )
-        return new_agent
-
-    def _mutate_agent(self, agent):
-        choice = np.random.random(len(agent.gene)) < self.mutation_bitwise_rate
-        new_agent = agent.__class__(
-            [
-                (agent.gene[i] if choice[i] else np.random.uniform())
-                for i in range(len(choice))
-            ],
-            [
-                (agent.param_gene[i] if choice[i] else agent.rules[i].generate_param())
-                for i in range(len(choice))
-            ],
-        )
-        logger.debug(
-            f"Mutating agent's gene from '{agent.gene}' to '{new_agent.gene}', param_gene from '{agent.param_gene}' to '{new_agent.param_gene}' "
+    def _mutate_genes(self, genes, keep):
+        return np.where(keep, genes, np.random.uniform(size=genes.shape))
+
+    def _mutate_params(self, params, keep, rules):
+        # A mutated rule draws both a new weight and new parameters.
+        fresh = np.concatenate(
+            [rule.generate_params(len(params)) for rule in rules], axis=1
         )
-        return new_agent
+        return np.where(np.repeat(keep, _param_sizes(rules), axis=1), params, fresh)
+
+
+def _param_sizes(rules):
+    return [rule.generate_params(0).shape[1] for rule in rules]
 
 
 if __name__ == "__main__":
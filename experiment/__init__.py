@@ -2,20 +2,91 @@ import sys
 
 sys.path.append(".")
 
+import json
+import os
+import time
+
 import numpy as np
 import pandas as pd
 
+from experiment.background.signals import SIGNAL_BANK
 from experiment.util.config import logger
+from experiment.util.files import atomic_write
+from experiment.util.instrument import INSTRUMENTS
 import matplotlib.pyplot as plt
 
 
 class Experiment(object):
-    def __init__(self, population, evolution, market):
+    def __init__(self, population, evolution, market, racing=False, eta=2):
+        """
+        Args:
+            racing (bool): Evaluate training generations with ``Market.race``, only
+                scoring on every stock the agents the evolution may select.
+            eta (int): Reduction factor of each racing round.
+        """
         self.population = population
         self.evolution = evolution
         self.market = market
+        self.racing = racing
+        self.eta = eta
+        self.fitness = {}
+        self.skipped = []
+        self.stocks_scored = []
+
+    def evaluate(self, population, market=None, race=False):
+        """``market.evaluate``, but only sending agents whose fitness is unknown.
+
+        Fitness is remembered by market identity and agent fingerprint, so
+        survivors carried into the next generation are not scored again.
+
+        With ``race``, unknown agents go through ``market.race`` instead, keeping
+        as many as the evolution selects. Only full evaluations are remembered.
+        The number of stocks each agent was scored on is appended to
+        ``stocks_scored``.
+        """
+        market = market or self.market
+        keys = [(market.identity, agent.fingerprint) for agent in population]
+        unknown = {key: agent for key, agent in zip(keys, population) if key not in self.fitness}
+        full = len(market.stocks)
+        estimates = {}
+        if unknown and race:
+            keep = int(len(population) * self.evolution.survival_rate)
+            evaluation, counts = market.race(list(unknown.values()), keep, self.eta)
+            for key, fitness, count in zip(unknown, evaluation, counts):
+                if count == full:
+                    self.fitness[key] = fitness
+                else:
+                    estimates[key] = (fitness, count)
+        elif unknown:
+            evaluation = market.evaluate(list(unknown.values()))
+            self.fitness.update(zip(unknown, evaluation))
+        self.skipped.append(len(population) - len(unknown))
+        self.stocks_scored.append(
+            [estimates[key][1] if key in estimates else full for key in keys]
+        )
+        logger.info(
+            f"Evaluated {len(unknown)} agents ({len(estimates)} raced out), "
+            + f"skipped {self.skipped[-1]}."
+        )
+        return [
+            estimates[key][0] if key in estimates else self.fitness[key] for key in keys
+        ]
+
+    def train(self, epoch, report=None, checkpoint=None):
+        """Evolve the population for ``epoch`` epochs.
 
-    def train(self, epoch):
+        Args:
+            report (str): If given, path of a JSON file rewritten after every epoch
+                with one record per epoch: fitness, agents evaluated and skipped,
+                wall time, and the counters and timers of ``INSTRUMENTS`` if enabled.
+            checkpoint (str): If given, path of a ``.npz`` file rewritten after every
+                epoch, see ``save_checkpoint``. If it already exists, training
+                resumes after its last epoch and ends as an uninterrupted run would.
+
+        When racing, an epoch's best and average only count the agents scored on
+        every stock, so no estimate from a few stocks can become the best; the
+        report also records the average of all agents' estimates.
+        """
         logger.info("Experiment start. Parameters:")
         logger.info(
             f"Population: {len(self.population)} of {str(type(self.population[0]))}"
@@ -25,30 +96,125 @@ class Experiment(object):
         )
         population = self.population
         result = []
-        for i in range(epoch):
+        self.report = []
+        done = 0
+        if checkpoint and os.path.exists(checkpoint):
+            population, result, done = self.load_checkpoint(checkpoint)
+            assert done <= epoch, f"{checkpoint} is already at epoch {done}."
+            logger.info(f"Resumed from {checkpoint} after epoch {done}.")
+        for i in range(done, epoch):
             logger.info(f"Start epoch {i+1}/{epoch}.")
-            evaluation = self.market.evaluate(population)
-            best = max(evaluation)
-            avg = np.mean(evaluation)
+            start, before = time.perf_counter(), INSTRUMENTS.snapshot()
+            evaluation = self.evaluate(population, race=self.racing)
+            full = [
+                fitness
+                for fitness, scored in zip(evaluation, self.stocks_scored[-1])
+                if scored == len(self.market.stocks)
+            ]
+            best = max(full)
+            avg = np.mean(full)
             result.append([best, avg])
             logger.info(f"Generation {i}'s best: {best}, average: {avg}")
+            logger.info(f"Signal bank: {SIGNAL_BANK}")
 
-            population = self.evolution.evolve(population, evaluation)
+            scored = self.stocks_scored[-1] if self.racing else None
+            population = self.evolution.evolve(population, evaluation, scored)
+            self._record(i, best, avg, evaluation, start, before, report)
+            if checkpoint:
+                self.save_checkpoint(checkpoint, population, result, i + 1)
 
         self.population = population
         logger.info(f"Final population generated, start evaluation.")
-        self.train_eval = self.market.evaluate(population)
+        start, before = time.perf_counter(), INSTRUMENTS.snapshot()
+        self.train_eval = self.evaluate(population)
         best = max(self.train_eval)
         avg = np.mean(self.train_eval)
         result.append([best, avg])
         logger.info(f"Final population's best: {best}, average: {avg}")
+        self._record(epoch, best, avg, self.train_eval, start, before, report)
+        if INSTRUMENTS.enabled:
+            logger.info(f"Instruments: {INSTRUMENTS}")
 
         self.history = pd.DataFrame(result, columns=["best", "avg"])
         return self.history
 
+    def _record(self, epoch, best, avg, evaluation, start, before, report):
+        self.report.append(
+            {
+                "epoch": epoch,
+                "best": float(best),
+                "avg": float(avg),
+                "evaluated": len(self.population) - self.skipped[-1],
+                "skipped": self.skipped[-1],
+                "stocks_scored": int(np.sum(self.stocks_scored[-1])),
+                "fully_scored": int(
+                    np.sum(np.array(self.stocks_scored[-1]) == len(self.market.stocks))
+                ),
+                "estimated_avg": float(np.mean(evaluation)),
+                "seconds": time.perf_counter() - start,
+                **INSTRUMENTS.since(before),
+            }
+        )
+        if report:
+            with atomic_write(report) as f:
+                json.dump(self.report, f, indent=1)
+
+    def save_checkpoint(self, path, population, history, epoch):
+        """Write everything a resumed ``train`` needs after ``epoch`` epochs.
+
+        The population is saved as its gene (and param) matrix, the fitness cache
+        of the training market as fingerprints and values, next to the history
+        rows, the epoch records and the state of NumPy's global RNG, all in one
+        compressed ``.npz`` file, replaced atomically.
+        """
+        agent_class = type(population[0])
+        genes, params = agent_class.to_matrix(population)
+        identity = self.market.identity
+        cached = [(key[1], value) for key, value in self.fitness.items() if key[0] == identity]
+        _, keys, pos, has_gauss, gauss = np.random.get_state()
+        arrays = {
+            "epoch": epoch,
+            "agent": agent_class.__name__,
+            "market": repr(identity),
+            "genes": genes,
+            "fingerprints": np.array([key for key, _ in cached], dtype="S32"),
+            "fitness": np.array([value for _, value in cached], dtype=float),
+            "history": np.array(history, dtype=float).reshape(-1, 2),
+            "report": json.dumps(self.report),
+            "rng_keys": keys,
+            "rng_state": np.array([pos, has_gauss]),
+            "rng_gauss": gauss,
+        }
+        if params is not None:
+            arrays["params"] = params
+        with atomic_write(path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+
+    def load_checkpoint(self, path):
+        """Restore the fitness cache, epoch records and RNG state of ``path``.
+
+        Returns:
+            tuple: The saved population, history rows and number of epochs done.
+        """
+        agent_class = type(self.population[0])
+        identity = self.market.identity
+        with np.load(path) as data:
+            assert str(data["agent"]) == agent_class.__name__, f"{path} is not of {agent_class.__name__}."
+            assert str(data["market"]) == repr(identity), f"{path} was trained on another market."
+            params = data["params"] if "params" in data else None
+            population = agent_class.from_matrix(data["genes"], params)
+            fingerprints = [key.decode() for key in data["fingerprints"]]
+            self.fitness.update(
+                ((identity, key), value) for key, value in zip(fingerprints, data["fitness"].tolist())
+            )
+            self.report = json.loads(str(data["report"]))
+            pos, has_gauss = data["rng_state"].tolist()
+            np.random.set_state(("MT19937", data["rng_keys"], pos, has_gauss, float(data["rng_gauss"])))
+            return population, data["history"].tolist(), int(data["epoch"])
+
     def test(self, market):
         logger.info("Start testing.")
-        test_eval = market.evaluate(self.population)
+        test_eval = self.evaluate(self.population, market)
         self.test_max = max(test_eval)
         self.test_mean = np.mean(test_eval)
         logger.info(f"Test best: {self.test_max}, average: {self.test_mean}")
@@ -80,9 +246,8 @@ if __name__ == "__main__":
 
     population = [GeneticComplexAgent() for _ in range(10)]
     evolution = ComplexEvolution(0.6, 0.75, 0.1)
-    market = Market(TRAIN_START, TRAIN_END)
-    test_market = Market(TEST_START, TEST_END)
-    e = Experiment(population, evolution, market)
-    e.train(3)
-    e.test(test_market)
+    with Market(TRAIN_START, TRAIN_END) as market, Market(TEST_START, TEST_END) as test_market:
+        e = Experiment(population, evolution, market)
+        e.train(3)
+        e.test(test_market)
     e.visualize()
@@ -2,23 +2,53 @@ import sys
 
 sys.path.append(".")
 
+import hashlib
+from functools import lru_cache
 from typing import *
 
 import numpy as np
 import pandas as pd
 
-from experiment.background.decision import Buy, Hold, Sell, make_decision
+from experiment.background.decision import (
+    Buy,
+    Hold,
+    Sell,
+    make_decision,
+    make_decisions,
+)
 from experiment.background.rules import *
 from experiment.background.util import KnowsFullTdf
-from experiment.util.data import read
+from experiment.util.data import get_source
+from experiment.util.instrument import INSTRUMENTS
 
 
 class Agent(object):
+    __slots__ = ()
+
     def decide(self, tdf: pd.DataFrame) -> Union[Buy, Sell, Hold]:
         raise NotImplementedError
 
 
+class Genome(object):
+    """Gene and flat rule-parameter array of a ``GeneticAgent``, all it takes to
+    rebuild the agent with ``from_genome``. ``params`` is None for simple agents."""
+
+    __slots__ = ("gene", "params")
+
+    def __init__(self, gene, params=None):
+        self.gene = gene
+        self.params = params
+
+    def __reduce__(self):
+        return (Genome, (self.gene, self.params))
+
+    def __repr__(self):
+        return f"Genome({self.gene!r}, {self.params!r})"
+
+
 class GeneticAgent(Agent):
+    # Rules are shared between agents, see ``intern_rule``.
+    __slots__ = ("gene", "rules")
 
     RULES = [
         SingleMACrossover,
@@ -49,18 +79,108 @@ class GeneticAgent(Agent):
     def init_rules(self):
         raise NotImplementedError
 
+    @property
+    def genome(self):
+        """``Genome`` rebuilding an equal agent with ``from_genome``."""
+        return Genome(self.gene)
+
+    @classmethod
+    def from_genome(cls, genome):
+        return cls(genome.gene)
+
+    def __reduce__(self):
+        # Pickle the genome only, rules are looked up again on the other side.
+        return (type(self).from_genome, (self.genome,))
+
+    @property
+    def fingerprint(self):
+        """Stable hash of the agent's class and genome, equal for equal agents."""
+        h = hashlib.blake2b(type(self).__name__.encode(), digest_size=16)
+        h.update(np.asarray(self.gene, dtype=float).tobytes())
+        params = self.genome.params
+        if params is not None:
+            h.update(params.tobytes())
+        return h.hexdigest()
+
+    @classmethod
+    def to_matrix(cls, agents):
+        """Genomes of ``agents`` as a gene matrix, one row per agent, and a param
+        matrix (None unless the agents have rule parameters)."""
+        return np.array([agent.gene for agent in agents]), None
+
+    @classmethod
+    def from_matrix(cls, genes, params=None):
+        """Inverse of ``to_matrix``: one agent per row."""
+        return [cls(gene) for gene in genes]
+
     def decide(self, tdf):
-        rule_decisions = np.array([rule.decide(tdf) for rule in self.rules])
-        vote_decision = (rule_decisions * self.gene).sum()
+        rule_decisions = np.array([int(_decide(rule, tdf)) for rule in self.rules], dtype=np.int8)
+        vote_decision = vote(rule_decisions[:, None], self.gene)[0]
         return make_decision(vote_decision)
 
+    def decide_series(self, tdf):
+        """Vectorized ``decide`` over every day of ``tdf``, as an int8 array."""
+        rule_decisions = np.array([rule.decide_series(tdf) for rule in self.rules])
+        return make_decisions(vote(rule_decisions, self.gene))
+
+    def stream(self):
+        """Online ``decide``, fed one bar at a time, see ``AgentStream``."""
+        return AgentStream(self)
+
+
+def _decide(rule, tdf):
+    with INSTRUMENTS.timer("rule", type(rule).__name__, "decide"):
+        return rule.decide(tdf)
+
+
+class AgentStream(object):
+    """``GeneticAgent.decide`` for bars arriving one at a time, in constant time per bar.
+
+    Replaying a history gives the same decisions as ``decide_series``.
+    """
+
+    def __init__(self, agent: GeneticAgent):
+        self.gene = agent.gene
+        self.streams = [rule.stream() for rule in agent.rules]
+
+    def update(self, bar):
+        rule_decisions = np.array([int(stream.update(bar)) for stream in self.streams], dtype=np.int8)
+        vote_decision = vote(rule_decisions[:, None], self.gene)[0]
+        return make_decision(vote_decision)
+
+
+def vote(rule_decisions, gene):
+    """Gene-weighted sum of the rules' decision series.
+
+    ``rule_decisions`` is (rules, days) or (agents, rules, days), ``gene`` is
+    (rules,) or (agents, rules); a gene matrix against a shared signal matrix
+    gives every agent's votes at once. The sum runs rule by rule, unlike
+    NumPy's pairwise ``sum``, and ``GeneticAgent.decide`` and ``AgentStream``
+    vote through it one day at a time: near-cancelling decimal genes must give
+    the same zero, or the same tiny nonzero, vote on every path.
+    """
+    gene = np.asarray(gene)
+    vote_decision = rule_decisions[..., 0, :] * gene[..., 0, None]
+    for i in range(1, gene.shape[-1]):
+        vote_decision = vote_decision + rule_decisions[..., i, :] * gene[..., i, None]
+    return vote_decision
+
 
 class GeneticSimpleAgent(GeneticAgent):
+    __slots__ = ()
+
     def init_rules(self):
-        self.rules = [rule() for rule in self.RULES]
+        self.rules = _default_rules(tuple(self.RULES))
+
+
+@lru_cache(maxsize=None)
+def _default_rules(rules):
+    return tuple(intern_rule(rule, ()) for rule in rules)
 
 
 class GeneticBitAgent(GeneticSimpleAgent):
+    __slots__ = ()
+
     def __init__(self, gene=None):
         if gene is None:
             self.gene = np.random.randint(0, 2, len(self.RULES))
@@ -70,6 +190,8 @@ class GeneticBitAgent(GeneticSimpleAgent):
 
 
 class GeneticRealAgent(GeneticSimpleAgent):
+    __slots__ = ()
+
     def __init__(self, gene=None):
         if gene is None:
             self.gene = np.random.random(len(self.RULES))
@@ -79,34 +201,93 @@ class GeneticRealAgent(GeneticSimpleAgent):
 
 
 class GeneticComplexAgent(GeneticAgent):
+    __slots__ = ("params",)
+
     def __init__(self, gene=None, param_gene=None):
+        """Agent evolving the parameters of its rules along with their weights.
+
+        Args:
+            param_gene: Each rule's parameters, as a list of ``generate_param``
+                lists or as one flat float array (see ``param_sizes``).
+        """
         if gene is None:
             self.gene = np.random.random(len(self.RULES))
         else:
             self._init_with_gene(gene)
 
         if param_gene is None:
-            self.param_gene = [rule.generate_param() for rule in self.RULES]
+            self.params = np.concatenate(
+                [rule.generate_params(1)[0] for rule in self.RULES]
+            )
+        elif isinstance(param_gene, np.ndarray) and param_gene.ndim == 1:
+            assert len(param_gene) == _param_bounds(tuple(self.RULES))[-1]
+            self.params = param_gene.astype(float, copy=False)
         else:
-            self.param_gene = param_gene
+            assert len(param_gene) == len(self.RULES)
+            self.params = np.concatenate(
+                [np.asarray(p, dtype=float) for p in param_gene]
+            )
         super().__init__()
 
+    @property
+    def param_gene(self):
+        """Each rule's parameters, as ``generate_param`` lists."""
+        bounds = _param_bounds(tuple(self.RULES))
+        return [
+            rule.param_list(self.params[a:b])
+            for rule, a, b in zip(self.RULES, bounds, bounds[1:])
+        ]
+
+    @property
+    def genome(self):
+        return Genome(self.gene, self.params)
+
+    @classmethod
+    def from_genome(cls, genome):
+        return cls(genome.gene, genome.params)
+
+    @classmethod
+    def to_matrix(cls, agents):
+        # Each rule's parameters take ``param_sizes`` consecutive columns.
+        params = np.array([agent.params for agent in agents]).reshape(len(agents), -1)
+        return np.array([agent.gene for agent in agents]), params
+
+    @classmethod
+    def from_matrix(cls, genes, params=None):
+        return [cls(gene, row) for gene, row in zip(genes, params)]
+
+    @classmethod
+    def param_sizes(cls):
+        return np.diff(_param_bounds(tuple(cls.RULES))).tolist()
+
     def init_rules(self):
-        self.rules = [rule(*gene) for rule, gene in zip(self.RULES, self.param_gene)]
+        values = self.params.tolist()
+        bounds = _param_bounds(tuple(self.RULES))
+        self.rules = tuple(
+            intern_rule(rule, values[a:b])
+            for rule, a, b in zip(self.RULES, bounds, bounds[1:])
+        )
+
+
+@lru_cache(maxsize=None)
+def _param_bounds(rules):
+    sizes = [rule.generate_params(0).shape[1] for rule in rules]
+    return tuple(np.cumsum([0] + sizes).tolist())
 
 
 class BenchmarkAgent(Agent, KnowsFullTdf):
-    def __init__(self, symbol):
-        self.full_tdf = read(symbol)
+    def __init__(self, symbol, source=None):
+        self.full_tdf = (source or get_source()).read(symbol)
+        self.close = self.full_tdf.close.values
 
     def decide(self, tdf):
-        today = tdf.index[-1]
-        tomorrow = self._next_day(today)
+        today = self.calendar.position(tdf.index[-1])
+        tomorrow = self.calendar.next_day(today)
 
-        ts = self.full_tdf.close
-        if ts.loc[today] > ts.loc[tomorrow]:
+        ts = self.close
+        if ts[today] > ts[tomorrow]:
             return Sell()
-        elif ts.loc[today] < ts.loc[tomorrow]:
+        elif ts[today] < ts[tomorrow]:
             return Buy()
         else:
             return Hold()
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class Decision(object):
     def __add__(self, other):
         return int(self) + other
@@ -36,6 +39,11 @@ def make_decision(n: float) -> Decision:
         return Hold()
 
 
+def make_decisions(n: np.ndarray) -> np.ndarray:
+    """Array form of ``make_decision``: int8 Buy (1), Sell (-1) or Hold (0)."""
+    return np.where(n > 0, 1, np.where(n < 0, -1, 0)).astype(np.int8)
+
+
 class Buy(Decision):
     def __int__(self):
         return 1
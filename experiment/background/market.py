@@ -2,88 +2,448 @@ import sys
 
 sys.path.append(".")
 
+import copy
 import glob
 import logging
+import math
 import os
+import time
+from collections import OrderedDict
 from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
 
-from experiment.background.agent import Agent, BenchmarkAgent, GeneticAgent
+from experiment.background.agent import (
+    Agent,
+    BenchmarkAgent,
+    GeneticAgent,
+    vote,
+)
+from experiment.background.decision import make_decisions
+from experiment.background.panel import Panel
+from experiment.background.signals import SIGNAL_BANK
 from experiment.background.util import KnowsFullTdf
 from experiment.util.config import *
-from experiment.util.data import ALL_SYMBOLS, read
+from experiment.util.data import REGISTRY, get_source
+from experiment.util.instrument import INSTRUMENTS, instrumented_task
 
 
 class Market(KnowsFullTdf):
-    def __init__(self, start_date, end_date, all_symbols=ALL_SYMBOLS, processes=CORES):
-        self.stocks = [Stock(start_date, end_date, symbol) for symbol in all_symbols]
-        self.benchmark = [
-            stock.trade_by(agent)
-            for stock, agent in zip(
-                self.stocks, [BenchmarkAgent(symbol) for symbol in all_symbols]
-            )
+    def __init__(
+        self, start_date, end_date, all_symbols=None, processes=CORES, source=None
+    ):
+        """Stocks traded together from ``start_date`` to ``end_date``.
+
+        Args:
+            all_symbols (list): Stocks traded, by default every symbol of ``source``.
+            source: Data source of the stocks, by default ``data.get_source()``,
+                e.g. a ``synthetic.SyntheticSource``.
+        """
+        source = source or get_source()
+        if all_symbols is None:
+            all_symbols = source.symbols()
+        self.stocks = [
+            Stock(start_date, end_date, symbol, source) for symbol in all_symbols
         ]
+        # Aligned once, genetic agents trade every stock together on the panel.
+        self.panel = Panel.of(self.stocks, (source, tuple(all_symbols)))
+        self.benchmark = benchmark(self.stocks)
         self.processes = processes
+        self.source = source
+        self.identity = (start_date, end_date, tuple(all_symbols), source)
+        self._pool = None
+        memory = self.memory()
+        logger.info(
+            f"Market of {len(self.stocks)} stocks from {source}: "
+            + ", ".join(f"{name} {n / 2 ** 20:.1f} MiB" for name, n in memory.items())
+        )
+
+    def memory(self):
+        """Bytes of the stocks' histories (shared ones once), of the panel, and of
+        the signals banked in this process, by any Market."""
+        frames = {id(stock.full_tdf): stock.full_tdf for stock in self.stocks}
+        return {
+            "histories": int(sum(df.memory_usage().sum() for df in frames.values())),
+            "panel": int(self.panel.nbytes),
+            "signals": int(SIGNAL_BANK.nbytes),
+        }
+
+    @property
+    def pool(self):
+        """Worker pool kept for the Market's lifetime, each worker loading the stocks once."""
+        if self._pool is None:
+            with INSTRUMENTS.timer("market.pool_start"):
+                self._pool = Pool(
+                    processes=self.processes,
+                    initializer=_init_worker,
+                    initargs=self.identity,
+                )
+        return self._pool
+
+    def _map(self, func, tasks):
+        """``pool.map``, bringing back the workers' counters when instrumented."""
+        if not INSTRUMENTS.enabled:
+            return self.pool.map(func, tasks)
+        results = self.pool.map(
+            instrumented_task, [(func, task, time.time()) for task in tasks]
+        )
+        for _, snapshot in results:
+            INSTRUMENTS.merge(snapshot)
+        return [result for result, _ in results]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
 
-    def trade_by(self, agents):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
+    def window(self, start_date, end_date, processes=None):
+        """The same stocks traded from ``start_date`` to ``end_date`` instead.
+
+        Stocks keep their loaded history and calendar, so no data is read again,
+        and as signals are computed and banked over full histories, every window
+        of a Market reuses those of the others.
+        """
+        market = copy.copy(self)
+        market.stocks = [stock.window(start_date, end_date) for stock in self.stocks]
+        market.benchmark = benchmark(market.stocks)
+        market.processes = processes or self.processes
+        market.identity = (start_date, end_date, self.identity[2], self.source)
+        market._pool = None
+        return market
+
+    def trading_days(self):
+        """Days on which every stock was traded."""
+        return self.panel.index[self.panel.mask.all(axis=1)]
+
+    def trade_by(self, agents, stocks=None):
+        """Revenue of each agent on each stock.
+
+        Args:
+            stocks (list): Positions in ``self.stocks`` of the stocks to trade,
+                all of them if None.
+        """
         assert isinstance(agents, list)
+        if stocks is None:
+            stocks = range(len(self.stocks))
+        stocks = list(stocks)
+        if all(isinstance(agent, GeneticAgent) for agent in agents):
+            return self._trade_population(agents, stocks)
+        if self.processes == 1:
+            return [self._trade_one_agent(agent, stocks) for agent in agents]
+        else:
+            return self._map(_worker_trade_one_agent, [(agent, stocks) for agent in agents])
+
+    def _trade_population(self, agents, stocks):
+        """Trade all genetic agents together on every stock at once, see ``trade_panel``.
+
+        Workers already hold the stocks, so a task only carries a slice of the
+        population, pickled as bare genomes, and returns that slice's revenues.
+        """
         if self.processes == 1:
-            return [self._trade_one_agent(agent) for agent in agents]
+            revenues = trade_panel(self.panel, self.stocks, agents, stocks)
         else:
-            with Pool(processes=self.processes) as pool:
-                return pool.map(self._trade_one_agent, agents)
+            chunks = [
+                (agents[chunk[0] : chunk[-1] + 1], stocks)
+                for chunk in np.array_split(np.arange(len(agents)), self.processes)
+                if len(chunk)
+            ]
+            revenues = np.concatenate(self._map(_worker_trade_population, chunks))
+        return list(revenues)
 
-    def _trade_one_agent(self, agent):
+    def _trade_one_agent(self, agent, stocks):
         assert isinstance(agent, Agent)
-        return [stock.trade_by(agent) for stock in self.stocks]
+        return [self.stocks[i].trade_by(agent) for i in stocks]
 
     def evaluate(self, agents):
         assert isinstance(agents, list)
-        return [
-            (np.array(raw_result) / self.benchmark).mean()
-            for raw_result in self.trade_by(agents)
+        with INSTRUMENTS.timer("market.evaluate"):
+            return [
+                (np.array(raw_result) / self.benchmark).mean()
+                for raw_result in self.trade_by(agents)
+            ]
+
+    def race(self, agents, keep, eta: int = 2, first: int = None):
+        """``evaluate`` by successive halving, only fully scoring the best agents.
+
+        All agents are scored on a random subset of the stocks, the worst are
+        dropped so that a ``1 / eta`` share remain, and the survivors are scored
+        on ``eta`` times as many stocks, until no more than ``keep`` remain or
+        every stock is scored. The final survivors, at least ``keep`` of them,
+        are then scored on every stock. Each round compares agents on the same
+        stocks, and no stock is traded twice by the same agent.
+
+        Args:
+            keep (int): Agents to score fully, e.g. as many as the evolution selects.
+            eta (int): Reduction factor of each round.
+            first (int): Stocks of the first round, by default so that the rounds
+                reach all stocks as they reach ``keep`` agents.
+
+        Returns:
+            tuple: Each agent's estimated fitness, its mean revenue-to-benchmark
+                ratio over the stocks it was scored on (exactly ``evaluate``'s when
+                scored on all), and the number of those stocks.
+        """
+        assert isinstance(agents, list)
+        n = len(self.stocks)
+        if first is None:
+            rounds = math.ceil(math.log(max(len(agents) / max(keep, 1), 1), eta))
+            first = math.ceil(n / eta ** rounds)
+        order = np.random.permutation(n)
+        ratios = np.full((len(agents), n), np.nan)
+        alive = np.arange(len(agents))
+        scored, size = 0, max(1, first)
+        with INSTRUMENTS.timer("market.race"):
+            while True:
+                new = order[scored:size]
+                revenues = np.array(self.trade_by([agents[i] for i in alive], new))
+                ratios[alive[:, None], new] = revenues / np.array(self.benchmark)[new]
+                scored = size
+                if scored == n:
+                    break
+                estimate = ratios[alive[:, None], order[:scored]].mean(axis=1)
+                survivors = max(keep, math.ceil(len(alive) / eta))
+                alive = alive[np.argsort(-estimate, kind="stable")[:survivors]]
+                size = n if len(alive) <= keep else min(size * eta, n)
+        counts = (~np.isnan(ratios)).sum(axis=1)
+        fitness = [
+            row.mean() if count == n else np.nanmean(row)
+            for row, count in zip(ratios, counts)
         ]
+        INSTRUMENTS.count("market.race.stocks_scored", int(counts.sum()))
+        return fitness, list(counts)
 
 
 class Stock(KnowsFullTdf):
-    def __init__(self, start_date, end_date, symbol):
-        self.full_tdf = read(symbol)
+    def __init__(self, start_date, end_date, symbol, source=None):
+        source = source or get_source()
+        self.full_tdf = source.read(symbol)
         self.start_date = start_date
         self.end_date = end_date
         self.symbol = symbol
+        self.source = source
+        self.close = self.full_tdf.close.values
+        self.begin, self.end = self.calendar.bounds(start_date, end_date)
+        self.key = (source, symbol, start_date, end_date)
+
+    def window(self, start_date, end_date):
+        """This stock traded from ``start_date`` to ``end_date``, sharing its history."""
+        begin, end = self.calendar.bounds(start_date, end_date)
+        stock = copy.copy(self)
+        stock.start_date, stock.end_date = start_date, end_date
+        stock.begin, stock.end = begin, end
+        stock.key = (self.source, self.symbol, start_date, end_date)
+        return stock
 
     def trade_by(self, agent):
         assert isinstance(agent, Agent)
-        today = self.start_date
+        if isinstance(agent, GeneticAgent):
+            return self.backtest(agent.decide_series(self.full_tdf))
+        return self.trade_by_day(agent)
+
+    def backtest(self, decisions):
+        """``trade_by`` on decisions precomputed for every day of ``full_tdf``."""
+        with INSTRUMENTS.timer("stock.backtest"):
+            total_rev = backtest(
+                decisions[..., self.begin : self.end], self.close[self.begin : self.end + 1]
+            )
+        logger.debug("Trading '%s' ended. Total revenue: %s", self.symbol, total_rev)
+        return total_rev
+
+    def trade_by_day(self, agent):
+        """Reference implementation of ``trade_by``, asking ``agent`` day by day."""
+        assert isinstance(agent, Agent)
         agent_holding = False
         total_rev = 0
-        logger.debug(
-            f"Trading '{self.symbol}' start for {agent.__class__.__name__}{', with gene'+ str(list(agent.gene)) if isinstance(agent, GeneticAgent) else ''}"
-        )
-        while today < self.end_date:
-            tdf = self.full_tdf.loc[:today]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Trading '{self.symbol}' start for {agent.__class__.__name__}{', with gene'+ str(list(agent.gene)) if isinstance(agent, GeneticAgent) else ''}"
+            )
+        for today in range(self.begin, self.end):
+            tdf = self.full_tdf.iloc[: today + 1]
             decision = agent.decide(tdf)
-            price = self.full_tdf.close.loc[today]
+            price = float(self.close[today])
             if decision.buy() and not agent_holding:
                 total_rev -= price
                 agent_holding = True
             elif decision.sell() and agent_holding:
                 total_rev += price
                 agent_holding = False
-            logger.debug(f"On {today}, agent choose to {decision} on price {price}")
-            today = self._next_day(today)
+            logger.debug(
+                "On %s, agent choose to %s on price %s",
+                self.full_tdf.index[today],
+                decision,
+                price,
+            )
 
-        price = self.full_tdf.close.loc[today]
+        price = float(self.close[self.end])
         if agent_holding:
             total_rev += price
-        logger.debug(f"Trading ended. Total revenue: {total_rev}")
+        logger.debug("Trading ended. Total revenue: %s", total_rev)
         return total_rev
 
 
+_worker_stocks = []
+_worker_panel = []
+
+
+def _init_worker(start_date, end_date, all_symbols, source):
+    global _worker_stocks
+    _worker_stocks = [
+        Stock(start_date, end_date, symbol, source) for symbol in all_symbols
+    ]
+    _worker_panel[:] = [Panel.of(_worker_stocks, (source, tuple(all_symbols)))]
+
+
+def _worker_trade_population(task):
+    agents, stocks = task
+    return trade_panel(_worker_panel[0], _worker_stocks, agents, stocks)
+
+
+# Cells (agents x stocks x days) backtested at once by ``trade_panel``, bounding
+# the memory of its temporary arrays.
+PANEL_CHUNK_CELLS = 2 ** 21
+
+
+def trade_panel(panel, all_stocks, agents, stocks):
+    """Revenue of genetic ``agents`` on each of ``stocks``, in one pass over ``panel``.
+
+    Agents with equal rules, e.g. every simple agent, share one signal matrix,
+    voted on for all stocks and agents at once. Each stock only trades on its
+    own days between its own ``begin`` and ``end``, and sells at its own last
+    close, so revenues equal ``Stock.trade_by``'s to the bit.
+
+    Args:
+        panel (Panel): Panel of ``all_stocks``, in order.
+        stocks (list): Positions in ``all_stocks`` of the stocks to trade.
+
+    Returns:
+        np.ndarray: Revenue of each agent (rows) on each of ``stocks`` (columns).
+    """
+    columns = np.asarray(stocks, dtype=int)
+    begins = np.array([panel.rows[j][all_stocks[j].begin] for j in columns])[:, None]
+    ends = np.array([panel.rows[j][all_stocks[j].end] for j in columns])[:, None]
+    first, last = begins.min(), ends.max()
+    days = np.arange(first, last + 1)[None, :]
+    # (stocks x days): Hold outside each stock's own trading days.
+    traded = (
+        (days[:, :-1] >= begins)
+        & (days[:, :-1] < ends)
+        & panel.mask[first:last, columns].T
+    )
+    close = panel.filled_close[np.minimum(days, ends), columns[:, None]]
+
+    genes = np.array([agent.gene for agent in agents])
+    groups = {}
+    for i, agent in enumerate(agents):
+        groups.setdefault(agent.rules, []).append(i)
+    shape = traded.shape
+    chunk = max(1, PANEL_CHUNK_CELLS // max(1, shape[0] * shape[1]))
+    revenues = np.empty((len(agents), len(columns)))
+    for rules, members in groups.items():
+        with INSTRUMENTS.timer("stock.signals"):
+            rule_decisions = np.array(
+                [panel.signals(rule)[first:last, columns].T * traded for rule in rules]
+            ).reshape(len(rules), -1)
+        for start in range(0, len(members), chunk):
+            chunk_members = members[start : start + chunk]
+            with INSTRUMENTS.timer("stock.vote"):
+                decisions = make_decisions(vote(rule_decisions, genes[chunk_members]))
+            with INSTRUMENTS.timer("stock.backtest"):
+                revenues[chunk_members] = backtest(decisions.reshape(-1, *shape), close)
+    return revenues
+
+
+def _worker_trade_one_agent(task):
+    agent, stocks = task
+    return [_worker_stocks[i].trade_by(agent) for i in stocks]
+
+
+_benchmarks = OrderedDict()
+
+
+def benchmark(stocks):
+    """Revenue of ``BenchmarkAgent`` on each stock, without trading day by day.
+
+    The benchmark buys before every rise and sells before every fall, so its
+    decisions are the signs of the next day's price change. All stocks are
+    backtested together, aligned on their last day, and cached per
+    (source, symbol, start, end). The cache keeps the ``BENCHMARK_CACHE_SIZE``
+    most recently used, and forgets a symbol whenever ``REGISTRY`` drops its
+    history, e.g. because its file changed.
+    """
+    todo = [stock for stock in stocks if stock.key not in _benchmarks]
+    if todo:
+        n = max(stock.end - stock.begin for stock in todo)
+        decisions = np.zeros((len(todo), n), dtype=np.int8)
+        close = np.zeros((len(todo), n + 1))
+        for i, stock in enumerate(todo):
+            ts = stock.close[stock.begin : stock.end + 1]
+            # Hold on an empty account before the stock's own range starts.
+            decisions[i, n + 1 - len(ts) :] = make_decisions(ts[1:] - ts[:-1])
+            close[i, n + 1 - len(ts) :] = ts
+        _benchmarks.update(zip([stock.key for stock in todo], backtest(decisions, close)))
+    revenues = [_benchmarks[stock.key] for stock in stocks]
+    for stock in stocks:
+        _benchmarks.move_to_end(stock.key)
+    while len(_benchmarks) > BENCHMARK_CACHE_SIZE:
+        _benchmarks.popitem(last=False)
+    return revenues
+
+
+def _forget_benchmarks(symbol):
+    for key in [key for key in _benchmarks if key[1] == symbol]:
+        del _benchmarks[key]
+
+
+REGISTRY.listeners.append(_forget_benchmarks)
+
+
+def backtest(decisions, close):
+    """Array form of the trading loop in ``Stock.trade_by_day``.
+
+    The agent holds after a day exactly when its latest Buy or Sell so far was a
+    Buy. Revenue is accumulated in time order, so it equals the loop's to the bit.
+
+    Args:
+        decisions (np.ndarray): Buy (1), Sell (-1) or Hold (0) of every trading day,
+            on the last axis. Leading axes (e.g. one row per agent) are traded apart.
+        close (np.ndarray): Close price of every trading day, followed by the
+            price of the day on which a position still held is sold.
+
+    Returns:
+        Total revenue, one per leading index of ``decisions``.
+    """
+    decisions = np.asarray(decisions)
+    days = np.arange(decisions.shape[-1])
+    latest = np.maximum.accumulate(np.where(decisions != 0, days, -1), axis=-1)
+    holding = (latest >= 0) & (
+        np.take_along_axis(decisions, np.maximum(latest, 0), axis=-1) == 1
+    )
+
+    flat = np.zeros(decisions.shape[:-1] + (1,), dtype=bool)
+    before = np.concatenate([flat, holding], axis=-1)
+    after = np.concatenate([holding, flat], axis=-1)
+    # +1 sells at the close of the day, -1 buys.
+    trades = before.astype(np.int8) - after.astype(np.int8)
+    # In float64 whatever the prices are stored in, see ``data.compact``.
+    return np.cumsum(trades * close, axis=-1, dtype=np.float64)[..., -1]
+
+
 if __name__ == "__main__":
     SYMBOL = "CMS"
     a = BenchmarkAgent(SYMBOL)
-    m = Market(TRAIN_START, TRAIN_END, [SYMBOL])
-    assert m.evaluate([a])[0] == 1
+    with Market(TRAIN_START, TRAIN_END, [SYMBOL]) as m:
+        assert m.evaluate([a])[0] == 1
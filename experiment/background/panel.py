@@ -0,0 +1,101 @@
+import sys
+
+sys.path.append(".")
+
+import numpy as np
+import pandas as pd
+
+from experiment.background.signals import SIGNAL_BANK
+from experiment.util.data import FIELDS
+from experiment.util.instrument import INSTRUMENTS
+
+RULE_FIELDS = ["close", "high", "low", "volume"]
+# Columns decided at once, bounding the float64 copies rules compute on.
+DECIDE_COLUMNS = 256
+
+
+class Panel(object):
+    """Histories of several stocks aligned once on their combined calendar.
+
+    Every field is a (trading days x symbols) array in column-major order, of
+    the histories' own dtype (see ``data.compact``), so each column is computed
+    exactly like the stock's own series, and ``mask`` tells on which days each
+    stock traded; other cells are NaN, or zero for whole volumes. Rules decide over all columns whose
+    histories cover the same days in one ``decide_arrays`` call; a column with
+    missing days inside its history is decided on its own days instead.
+
+    Args:
+        frames (list): One history per symbol, as ``data.read`` returns.
+        key: Hashable description of the histories, e.g. their source and
+            symbols, keying the panel's signals in ``SIGNAL_BANK``.
+    """
+
+    def __init__(self, frames, key=None):
+        index = frames[0].index
+        for df in frames[1:]:
+            index = index.union(df.index)
+        self.index = index
+        self.key = (key, index[0], index[-1])
+        self.rows = [index.get_indexer(df.index) for df in frames]
+        shape = (len(index), len(frames))
+        self.mask = np.zeros(shape, dtype=bool, order="F")
+        self.fields = {}
+        for field in FIELDS:
+            dtype = np.result_type(*[df[field].dtype for df in frames])
+            fill = 0 if np.issubdtype(dtype, np.integer) else np.nan
+            self.fields[field] = np.full(shape, fill, dtype=dtype, order="F")
+        for j, (df, rows) in enumerate(zip(frames, self.rows)):
+            self.mask[rows, j] = True
+            for field in FIELDS:
+                self.fields[field][rows, j] = df[field].values
+
+        # Columns by the span of rows they fill completely, and columns with gaps.
+        self._blocks = {}
+        self._gapped = []
+        for j, rows in enumerate(self.rows):
+            if rows[-1] - rows[0] + 1 == len(rows):
+                self._blocks.setdefault((rows[0], rows[-1] + 1), []).append(j)
+            else:
+                self._gapped.append(j)
+        # Closes carried over missing days, zero before a stock's first day, for
+        # backtests, which only ever trade them zero times.
+        self.filled_close = np.asfortranarray(
+            pd.DataFrame(self.fields["close"]).ffill().fillna(0).values
+        )
+
+    @classmethod
+    def of(cls, stocks, key=None):
+        """Panel of the full histories of ``Stock``s, in order."""
+        return cls([stock.full_tdf for stock in stocks], key)
+
+    def decide(self, rule):
+        """``rule.decide_series`` of every stock, at its rows; Hold where it did not trade."""
+        with INSTRUMENTS.timer("panel.decide", type(rule).__name__):
+            decisions = np.zeros(self.mask.shape, dtype=np.int8, order="F")
+            for (first, last), block in self._blocks.items():
+                for start in range(0, len(block), DECIDE_COLUMNS):
+                    columns = block[start : start + DECIDE_COLUMNS]
+                    arrays = [
+                        np.asfortranarray(self.fields[field][first:last, columns], dtype=float)
+                        for field in RULE_FIELDS
+                    ]
+                    decisions[first:last, columns] = rule.decide_arrays(*arrays)
+            for j in self._gapped:
+                rows = self.rows[j]
+                arrays = [self.fields[field][rows, j].astype(float) for field in RULE_FIELDS]
+                decisions[rows, j] = rule.decide_arrays(*arrays)
+        return decisions
+
+    @property
+    def nbytes(self):
+        return (
+            sum(field.nbytes for field in self.fields.values())
+            + self.mask.nbytes
+            + self.filled_close.nbytes
+        )
+
+    def signals(self, rule):
+        """``decide``, banked in ``SIGNAL_BANK`` like the stocks' own signals."""
+        return SIGNAL_BANK.fetch(
+            (type(rule), rule.params, self.key), lambda: self.decide(rule)
+        )
@@ -2,22 +2,111 @@ import sys
 
 sys.path.append(".")
 
+import inspect
+import operator
+import weakref
+from collections import deque
+from functools import lru_cache
 from typing import *
 
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
-from experiment.background.decision import Buy, Hold, Sell
+from experiment.background.decision import Buy, Hold, Sell, make_decision
+from experiment.util.instrument import INSTRUMENTS
 
 
 class Rule(object):
     def decide(self, tdf: pd.DataFrame) -> Union[Buy, Sell, Hold]:
         raise NotImplementedError
 
+    def decide_series(self, tdf: pd.DataFrame) -> np.ndarray:
+        """Vectorized ``decide`` over every day of ``tdf``.
+
+        Element ``t`` of the returned int8 array equals ``int(self.decide(tdf.iloc[: t + 1]))``.
+        Days with too little history for ``decide`` to run at all are Hold.
+        """
+        with INSTRUMENTS.timer("rule", type(self).__name__, "decide_series"):
+            return self.decide_arrays(
+                _values(tdf.close),
+                _values(tdf.high),
+                _values(tdf.low),
+                _values(tdf.volume),
+            )
+
+    def decide_arrays(self, close, high, low, volume) -> np.ndarray:
+        """Same as ``decide_series``, on float arrays whose first axis is time.
+
+        Extra axes are computed side by side, e.g. one column per stock. Keep such
+        arrays column-major so each column is reduced exactly like a 1-D array.
+        """
+        raise NotImplementedError
+
+    @property
+    def lookback(self) -> int:
+        """Number of trailing days that fully determine today's decision."""
+        raise NotImplementedError
+
+    def stream(self) -> "RuleStream":
+        """Online ``decide``, fed one bar at a time through ``RuleStream.update``."""
+        raise NotImplementedError
+
+    @property
+    def params(self):
+        """Hashable summary of the rule's parameters, equal for equal rules."""
+        return tuple(
+            (name, value.params if isinstance(value, Rule) else value)
+            for name, value in sorted(vars(self).items())
+        )
+
     @staticmethod
     def generate_param():
         raise NotImplementedError
 
+    @classmethod
+    def generate_params(cls, n: int) -> np.ndarray:
+        """``n`` draws of ``generate_param`` at once, one row of floats per draw."""
+        return np.array([cls.generate_param() for _ in range(n)], dtype=float).reshape(
+            n, len(_param_types(cls))
+        )
+
+    @classmethod
+    def param_list(cls, row) -> list:
+        """A row of ``generate_params`` as a ``generate_param`` list, ints as ints."""
+        return [t(value) for t, value in zip(_param_types(cls), row)]
+
+
+_interned = weakref.WeakValueDictionary()
+
+
+def intern_rule(rule, params):
+    """The shared instance of ``rule(*rule.param_list(params))``.
+
+    Rules hold nothing but their parameters, so every agent using the same
+    parameters can use the same instance. Instances are dropped once no agent
+    refers to them.
+    """
+    key = (rule, tuple(params))
+    instance = _interned.get(key)
+    if instance is None:
+        instance = _interned[key] = rule(*rule.param_list(params))
+    return instance
+
+
+@lru_cache(maxsize=None)
+def _param_types(rule):
+    return tuple(
+        int if parameter.annotation is int else float
+        for parameter in inspect.signature(rule).parameters.values()
+    )
+
+
+def _ordered_pairs(r1, r2):
+    # Vectorized ``generate_param`` of the crossovers: distinct (short, long) windows.
+    r1 = r1 + (r1 == r2)
+    return np.column_stack([np.minimum(r1, r2), np.maximum(r1, r2)]).astype(float)
+
 
 class SingleMACrossover(Rule):
     def __init__(self, n: int = 28):
@@ -39,10 +128,29 @@ class SingleMACrossover(Rule):
         else:
             return Hold()
 
+    def decide_arrays(self, close, high, low, volume):
+        ma = _rolling(close, self.n, _mean)
+        ma_yesterday = _lag(ma)
+        yesterday = _lag(close)
+        buy = (close > ma) & (yesterday < ma_yesterday)
+        sell = (close < ma) & (yesterday > ma_yesterday)
+        return _to_signal(buy, sell)
+
+    @property
+    def lookback(self):
+        return self.n + 1
+
+    def stream(self):
+        return SingleMACrossoverStream(self)
+
     @staticmethod
     def generate_param():
         return [np.random.randint(10, 50)]
 
+    @staticmethod
+    def generate_params(n):
+        return np.random.randint(10, 50, (n, 1)).astype(float)
+
 
 class DoubleMACrossover(Rule):
     def __init__(self, short_n: int = 25, long_n: int = 50):
@@ -65,6 +173,22 @@ class DoubleMACrossover(Rule):
         else:
             return Hold()
 
+    def decide_arrays(self, close, high, low, volume):
+        ma_short = _rolling(close, self.short_n, _mean)
+        ma_long = _rolling(close, self.long_n, _mean)
+        ma_short_yesterday = _lag(ma_short)
+        ma_long_yesterday = _lag(ma_long)
+        buy = (ma_short > ma_long) & (ma_short_yesterday < ma_long_yesterday)
+        sell = (ma_short < ma_long) & (ma_short_yesterday > ma_long_yesterday)
+        return _to_signal(buy, sell)
+
+    @property
+    def lookback(self):
+        return self.long_n + 1
+
+    def stream(self):
+        return DoubleMACrossoverStream(self)
+
     @staticmethod
     def generate_param():
         r1 = np.random.randint(10, 50)
@@ -73,6 +197,10 @@ class DoubleMACrossover(Rule):
             r1 += 1
         return [min(r1, r2), max(r1, r2)]
 
+    @staticmethod
+    def generate_params(n):
+        return _ordered_pairs(np.random.randint(10, 50, n), np.random.randint(10, 50, n))
+
 
 class RelativeStrengthIndex(Rule):
     def __init__(
@@ -111,6 +239,17 @@ class RelativeStrengthIndex(Rule):
         else:
             return Hold()
 
+    def decide_arrays(self, close, high, low, volume):
+        RSI = _compute_RSI_series(close, self.n, self.avg_method)
+        return _to_signal(RSI < self.buy_signal, RSI > self.sell_signal)
+
+    @property
+    def lookback(self):
+        return self.n + 1
+
+    def stream(self):
+        return RelativeStrengthIndexStream(self)
+
     @staticmethod
     def generate_param():
         return [
@@ -120,6 +259,17 @@ class RelativeStrengthIndex(Rule):
             0,
         ]
 
+    @staticmethod
+    def generate_params(n):
+        return np.column_stack(
+            [
+                np.random.randint(10, 30, n),
+                np.random.randint(1, 50, n),
+                np.random.randint(51, 100, n),
+                np.zeros(n),
+            ]
+        ).astype(float)
+
 
 def _compute_RSI(ts, n, avg_method=0):
     _ts = ts.copy(deep=True)
@@ -142,6 +292,27 @@ def _compute_RSI(ts, n, avg_method=0):
         return 100 - 100 / (1 + RS)
 
 
+def _compute_RSI_series(close, n, avg_method=0):
+    """``_compute_RSI`` of every prefix of ``close``.
+
+    ``_compute_RSI`` lines a short history up against itself, so every day before
+    the ``n``-th gets an RSI of 100.
+    """
+    if avg_method != 0:
+        raise NotImplementedError
+
+    RSI = np.full(close.shape, 100.0)
+    if len(close) <= n:
+        return RSI
+    diff = close[1:] - close[:-1]
+    avg_up = _windows(np.where(diff > 0, diff, 0), n).sum(axis=1) / n
+    avg_down = _windows(np.where(diff < 0, -diff, 0), n).sum(axis=1) / n
+    with np.errstate(divide="ignore", invalid="ignore"):
+        RS = avg_up / avg_down
+        RSI[n:] = np.where(avg_down == 0, 100, 100 - 100 / (1 + RS))
+    return RSI
+
+
 class StochasticOscillator(Rule):
     def __init__(self, n: int = 14, buy_signal: int = 20, sell_signal: int = 80):
         assert n > 1
@@ -162,6 +333,20 @@ class StochasticOscillator(Rule):
         else:
             return Hold()
 
+    def decide_arrays(self, close, high, low, volume):
+        H = _rolling(high, self.n, _max)
+        L = _rolling(low, self.n, _min)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            K = (close - L) / (H - L) * 100
+        return _to_signal(K < self.buy_signal, K > self.sell_signal)
+
+    @property
+    def lookback(self):
+        return self.n
+
+    def stream(self):
+        return StochasticOscillatorStream(self)
+
     @staticmethod
     def generate_param():
         return [
@@ -170,6 +355,16 @@ class StochasticOscillator(Rule):
             np.random.randint(51, 100),
         ]
 
+    @staticmethod
+    def generate_params(n):
+        return np.column_stack(
+            [
+                np.random.randint(10, 30, n),
+                np.random.randint(1, 50, n),
+                np.random.randint(51, 100, n),
+            ]
+        ).astype(float)
+
 
 class MA918(DoubleMACrossover):
     def __init__(self):
@@ -179,6 +374,10 @@ class MA918(DoubleMACrossover):
     def generate_param():
         return []
 
+    @staticmethod
+    def generate_params(n):
+        return np.empty((n, 0))
+
 
 class MA4918(Rule):
     def __init__(self):
@@ -195,10 +394,26 @@ class MA4918(Rule):
         else:
             return Hold()
 
+    def decide_arrays(self, close, high, low, volume):
+        d1 = self.m1.decide_arrays(close, high, low, volume)
+        d2 = self.m2.decide_arrays(close, high, low, volume)
+        return _to_signal((d1 == 1) & (d2 == 1), (d1 == -1) & (d2 == -1))
+
+    @property
+    def lookback(self):
+        return self.m2.lookback
+
+    def stream(self):
+        return MA4918Stream(self)
+
     @staticmethod
     def generate_param():
         return []
 
+    @staticmethod
+    def generate_params(n):
+        return np.empty((n, 0))
+
 
 class MACD(Rule):
     def __init__(self, short_n: int = 12, long_n: int = 26, signal: float = 0):
@@ -228,6 +443,22 @@ class MACD(Rule):
     def _compute_EMA(self, ts, n):
         return ts.iloc[-n:].ewm(span=n).mean().iloc[-1]
 
+    def decide_arrays(self, close, high, low, volume):
+        MACD_today = _compute_EMA_series(close, self.short_n) - _compute_EMA_series(
+            close, self.long_n
+        )
+        MACD_yesterday = _lag(MACD_today)
+        buy = (MACD_yesterday < self.signal) & (MACD_today > self.signal)
+        sell = (MACD_yesterday > self.signal) & (MACD_today < self.signal)
+        return _to_signal(buy, sell)
+
+    @property
+    def lookback(self):
+        return self.long_n + 1
+
+    def stream(self):
+        return MACDStream(self)
+
     @staticmethod
     def generate_param():
         r1 = np.random.randint(10, 30)
@@ -236,6 +467,11 @@ class MACD(Rule):
             r1 += 1
         return [min(r1, r2), max(r1, r2), np.random.uniform(-0.1, 0.1)]
 
+    @staticmethod
+    def generate_params(n):
+        r1, r2 = np.random.randint(10, 30, n), np.random.randint(10, 30, n)
+        return np.column_stack([_ordered_pairs(r1, r2), np.random.uniform(-0.1, 0.1, n)])
+
 
 class MoneyFlowIndex(Rule):
     def __init__(self, n: int = 14, buy_signal: int = 10, sell_signal: int = 90):
@@ -280,6 +516,33 @@ class MoneyFlowIndex(Rule):
             MFI = 100 - 100 / (1 + money_ratio)
             return MFI
 
+    def decide_arrays(self, close, high, low, volume):
+        # ``decide`` needs ``n + 1`` rows for yesterday's MFI, even though it is unused.
+        MFI = np.full(close.shape, np.nan)
+        if len(close) > self.n + 1:
+            typical_price = (high + low + close) / 3
+            money_flow = typical_price * volume
+            rising = np.zeros(close.shape, dtype=bool)
+            rising[1:] = typical_price[1:] - typical_price[:-1] > 0
+            positive = np.where(rising, money_flow, 0)
+            negative = np.where(rising, 0, money_flow)
+            # The first day of each window carries no flow.
+            positive_flow = _windows(positive, self.n - 1).sum(axis=1)[3:]
+            negative_flow = _windows(negative, self.n - 1).sum(axis=1)[3:]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                money_ratio = positive_flow / negative_flow
+                MFI[self.n + 1 :] = np.where(
+                    negative_flow == 0, 100, 100 - 100 / (1 + money_ratio)
+                )
+        return _to_signal(MFI < self.buy_signal, MFI > self.sell_signal)
+
+    @property
+    def lookback(self):
+        return self.n + 2
+
+    def stream(self):
+        return MoneyFlowIndexStream(self)
+
     @staticmethod
     def generate_param():
         return [
@@ -288,6 +551,16 @@ class MoneyFlowIndex(Rule):
             np.random.randint(51, 100),
         ]
 
+    @staticmethod
+    def generate_params(n):
+        return np.column_stack(
+            [
+                np.random.randint(10, 30, n),
+                np.random.randint(1, 50, n),
+                np.random.randint(51, 100, n),
+            ]
+        ).astype(float)
+
 
 class CommodityChannelIndex(Rule):
     def __init__(
@@ -323,6 +596,28 @@ class CommodityChannelIndex(Rule):
         MD = typical_price.mad()
         return (p - SMA) / (MD * 0.015)
 
+    def decide_arrays(self, close, high, low, volume):
+        CCI = _rolling((high + low + close) / 3, self.CCI_n, _CCI)
+        now_CCI = CCI
+        max_CCI = min_CCI = _lag(CCI)
+        for i in range(2, self.trend_n):
+            old_CCI = _lag(CCI, i)
+            # Same NaN handling as the builtin ``max`` / ``min`` in ``decide``.
+            max_CCI = np.where(old_CCI > max_CCI, old_CCI, max_CCI)
+            min_CCI = np.where(old_CCI < min_CCI, old_CCI, min_CCI)
+        buy = (now_CCI > self.buy_signal) & (now_CCI > max_CCI)
+        sell = (now_CCI < self.sell_signal) & (now_CCI > min_CCI)
+        # ``decide`` needs ``trend_n - 1`` earlier days to look back on.
+        buy[: self.trend_n - 1] = sell[: self.trend_n - 1] = False
+        return _to_signal(buy, sell)
+
+    @property
+    def lookback(self):
+        return self.CCI_n + self.trend_n - 1
+
+    def stream(self):
+        return CommodityChannelIndexStream(self)
+
     @staticmethod
     def generate_param():
         return [
@@ -332,6 +627,17 @@ class CommodityChannelIndex(Rule):
             np.random.randint(50, 200),
         ]
 
+    @staticmethod
+    def generate_params(n):
+        return np.column_stack(
+            [
+                np.random.randint(10, 30, n),
+                np.random.randint(3, 15, n),
+                np.random.randint(-200, -50, n),
+                np.random.randint(50, 200, n),
+            ]
+        ).astype(float)
+
 
 class StochasticRSI(Rule):
     def __init__(self, n: int = 14, buy_signal: float = 0.2, sell_signal: float = 0.8):
@@ -363,6 +669,32 @@ class StochasticRSI(Rule):
         else:
             return (now_RSI - min_RSI) / (max_RSI - min_RSI)
 
+    def decide_arrays(self, close, high, low, volume):
+        # Days before the start of the history have an RSI of 100 in ``_compute_RSI``.
+        RSI = np.concatenate(
+            [np.full((self.n - 1,) + close.shape[1:], 100.0), _compute_RSI_series(close, self.n)]
+        )
+        now_RSI = RSI[self.n - 1 :]
+        max_RSI = min_RSI = RSI[self.n - 2 : -1]
+        for i in range(2, self.n):
+            old_RSI = RSI[self.n - 1 - i : len(RSI) - i]
+            max_RSI = np.where(old_RSI > max_RSI, old_RSI, max_RSI)
+            min_RSI = np.where(old_RSI < min_RSI, old_RSI, min_RSI)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            stochRSI = np.where(
+                max_RSI == min_RSI,
+                (now_RSI > min_RSI).astype(float),
+                (now_RSI - min_RSI) / (max_RSI - min_RSI),
+            )
+        return _to_signal(stochRSI < self.buy_signal, stochRSI > self.sell_signal)
+
+    @property
+    def lookback(self):
+        return 2 * self.n
+
+    def stream(self):
+        return StochasticRSIStream(self)
+
     @staticmethod
     def generate_param():
         return [
@@ -371,6 +703,441 @@ class StochasticRSI(Rule):
             np.random.uniform(0.5, 1),
         ]
 
+    @staticmethod
+    def generate_params(n):
+        return np.column_stack(
+            [
+                np.random.randint(10, 30, n),
+                np.random.uniform(0, 0.5, n),
+                np.random.uniform(0.5, 1, n),
+            ]
+        )
+
+
+class RuleStream(object):
+    """Online ``Rule.decide``: ``update`` takes the next bar and returns its decision.
+
+    Indicators are carried from bar to bar (rolling sums, EMA recursions,
+    monotonic deques) instead of being recomputed over their window. The
+    carried values round differently from ``decide_series``, so when one of
+    today's comparisons is too close to call, the decision is recomputed from
+    the last ``rule.lookback`` bars with the batch kernel. Replaying a history
+    therefore gives exactly the decisions of ``decide_series``.
+    """
+
+    FIELDS = ["close", "high", "low", "volume"]
+
+    def __init__(self, rule: Rule):
+        self.rule = rule
+        self.days = 0
+        self.bars = {field: deque(maxlen=rule.lookback) for field in self.FIELDS}
+
+    def update(self, bar) -> Union[Buy, Sell, Hold]:
+        """Decision on ``bar``, anything with close/high/low/volume attributes (e.g. ``tdf.iloc[t]``)."""
+        for field in self.FIELDS:
+            self.bars[field].append(float(getattr(bar, field)))
+        self.days += 1
+        decision = self._decide()
+        if decision is None:
+            arrays = [np.array(self.bars[field]) for field in self.FIELDS]
+            decision = self.rule.decide_arrays(*arrays)[-1]
+        return make_decision(decision)
+
+    def _decide(self):
+        """Today's decision as 1, -1 or 0, or None if it is too close to call."""
+        raise NotImplementedError
+
+
+class SingleMACrossoverStream(RuleStream):
+    def __init__(self, rule):
+        super().__init__(rule)
+        self.ma = _RollingSum(rule.n)
+        self.yesterday = None
+
+    def _decide(self):
+        today = self.bars["close"][-1]
+        self.ma.push(today)
+        ma_today = self.ma.mean
+        if self.yesterday is None:
+            self.yesterday = today, ma_today
+            return 0
+        yesterday, ma_yesterday = self.yesterday
+        self.yesterday = today, ma_today
+        return _decision(
+            _all(_gt(today, ma_today), _gt(ma_yesterday, yesterday)),
+            _all(_gt(ma_today, today), _gt(yesterday, ma_yesterday)),
+        )
+
+
+class DoubleMACrossoverStream(RuleStream):
+    def __init__(self, rule):
+        super().__init__(rule)
+        self.ma_short = _RollingSum(rule.short_n)
+        self.ma_long = _RollingSum(rule.long_n)
+        self.yesterday = None
+
+    def _decide(self):
+        self.ma_short.push(self.bars["close"][-1])
+        self.ma_long.push(self.bars["close"][-1])
+        today = self.ma_short.mean, self.ma_long.mean
+        if self.yesterday is None:
+            self.yesterday = today
+            return 0
+        (short_today, long_today), (short_yesterday, long_yesterday) = today, self.yesterday
+        self.yesterday = today
+        return _decision(
+            _all(_gt(short_today, long_today), _gt(long_yesterday, short_yesterday)),
+            _all(_gt(long_today, short_today), _gt(short_yesterday, long_yesterday)),
+        )
+
+
+class RelativeStrengthIndexStream(RuleStream):
+    def __init__(self, rule):
+        if rule.avg_method != 0:
+            raise NotImplementedError
+        super().__init__(rule)
+        self.RSI = _RSIStream(rule.n)
+
+    def _decide(self):
+        RSI = self.RSI.push(self.bars["close"][-1])
+        return _decision(_gt(self.rule.buy_signal, RSI), _gt(RSI, self.rule.sell_signal))
+
+
+class StochasticOscillatorStream(RuleStream):
+    def __init__(self, rule):
+        super().__init__(rule)
+        self.high = _RollingExtreme(rule.n, operator.gt)
+        self.low = _RollingExtreme(rule.n, operator.lt)
+
+    def _decide(self):
+        # Highs, lows and closes are exact, so K is too.
+        C = np.float64(self.bars["close"][-1])
+        H = self.high.push(self.bars["high"][-1])
+        L = self.low.push(self.bars["low"][-1])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            K = (C - L) / (H - L) * 100
+        return _decision(K < self.rule.buy_signal, K > self.rule.sell_signal)
+
+
+class MA4918Stream(RuleStream):
+    def __init__(self, rule):
+        super().__init__(rule)
+        self.streams = [rule.m1.stream(), rule.m2.stream()]
+
+    def update(self, bar):
+        self.decisions = [int(stream.update(bar)) for stream in self.streams]
+        return super().update(bar)
+
+    def _decide(self):
+        d1, d2 = self.decisions
+        return _decision(d1 == 1 and d2 == 1, d1 == -1 and d2 == -1)
+
+
+class MACDStream(RuleStream):
+    def __init__(self, rule):
+        super().__init__(rule)
+        self.short_EMA = _WindowedEMA(rule.short_n)
+        self.long_EMA = _WindowedEMA(rule.long_n)
+        self.MACD_yesterday = None
+
+    def _decide(self):
+        today = self.bars["close"][-1]
+        MACD_today = self.short_EMA.push(today) - self.long_EMA.push(today)
+        MACD_yesterday, self.MACD_yesterday = self.MACD_yesterday, MACD_today
+        if MACD_yesterday is None:
+            return 0
+        signal = self.rule.signal
+        return _decision(
+            _all(_gt(signal, MACD_yesterday), _gt(MACD_today, signal)),
+            _all(_gt(MACD_yesterday, signal), _gt(signal, MACD_today)),
+        )
+
+
+class MoneyFlowIndexStream(RuleStream):
+    def __init__(self, rule):
+        super().__init__(rule)
+        self.positive_flow = _RollingSum(rule.n - 1)
+        self.negative_flow = _RollingSum(rule.n - 1)
+        self.typical_price = None
+
+    def _decide(self):
+        typical_price = (self.bars["high"][-1] + self.bars["low"][-1] + self.bars["close"][-1]) / 3
+        money_flow = typical_price * self.bars["volume"][-1]
+        rising = self.typical_price is not None and typical_price - self.typical_price > 0
+        self.typical_price = typical_price
+        self.positive_flow.push(money_flow if rising else 0.0)
+        self.negative_flow.push(0.0 if rising else money_flow)
+        if self.days < self.rule.n + 2:
+            return 0
+        if self.negative_flow.sum == 0:
+            MFI = 100
+        else:
+            MFI = 100 - 100 / (1 + self.positive_flow.sum / self.negative_flow.sum)
+        return _decision(_gt(self.rule.buy_signal, MFI), _gt(MFI, self.rule.sell_signal))
+
+
+class CommodityChannelIndexStream(RuleStream):
+    """The mean deviation has no running form: each bar costs O(``CCI_n``), exactly
+    as in ``decide_arrays``, rather than O(1)."""
+
+    def __init__(self, rule):
+        super().__init__(rule)
+        self.typical_price = deque(maxlen=rule.CCI_n)
+        self.old_CCIs = deque(maxlen=rule.trend_n - 1)
+
+    def _decide(self):
+        self.typical_price.append(
+            (self.bars["high"][-1] + self.bars["low"][-1] + self.bars["close"][-1]) / 3
+        )
+        now_CCI = _CCI(np.array(self.typical_price)[None])[0]
+        old_CCIs = list(reversed(self.old_CCIs))
+        self.old_CCIs.append(now_CCI)
+        if self.days < self.rule.trend_n:
+            return 0
+        if now_CCI > self.rule.buy_signal and now_CCI > max(old_CCIs):
+            return 1
+        elif now_CCI < self.rule.sell_signal and now_CCI > min(old_CCIs):
+            return -1
+        else:
+            return 0
+
+
+class StochasticRSIStream(RuleStream):
+    def __init__(self, rule):
+        super().__init__(rule)
+        self.RSI = _RSIStream(rule.n)
+        # Days before the start of the history have an RSI of 100.
+        self.max_RSI = _RollingExtreme(rule.n - 1, operator.gt)
+        self.min_RSI = _RollingExtreme(rule.n - 1, operator.lt)
+        for _ in range(rule.n - 1):
+            self.max_RSI.push(100.0)
+            self.min_RSI.push(100.0)
+
+    def _decide(self):
+        now_RSI = self.RSI.push(self.bars["close"][-1])
+        max_RSI, min_RSI = self.max_RSI.value, self.min_RSI.value
+        self.max_RSI.push(now_RSI)
+        self.min_RSI.push(now_RSI)
+        if _gt(max_RSI, min_RSI) is not True:
+            return None
+        stochRSI = (now_RSI - min_RSI) / (max_RSI - min_RSI)
+        return _decision(
+            _gt(self.rule.buy_signal, stochRSI), _gt(stochRSI, self.rule.sell_signal)
+        )
+
+
+class _RollingSum(object):
+    """Sum of the last ``n`` values pushed.
+
+    Re-added from scratch every ``n`` pushes so rounding errors cannot build up,
+    and exactly zero while the window only holds zeros.
+    """
+
+    def __init__(self, n):
+        self.values = deque(maxlen=n)
+        self.running = 0.0
+        self.nonzero = 0
+        self.pushes = 0
+
+    def push(self, x):
+        if len(self.values) == self.values.maxlen:
+            self.running -= self.values[0]
+            self.nonzero -= self.values[0] != 0
+        self.values.append(x)
+        self.running += x
+        self.nonzero += x != 0
+        self.pushes += 1
+        if self.pushes % self.values.maxlen == 0:
+            self.running = sum(self.values)
+
+    @property
+    def sum(self):
+        return self.running if self.nonzero else 0.0
+
+    @property
+    def mean(self):
+        return self.sum / len(self.values)
+
+
+class _RollingExtreme(object):
+    """Max (``operator.gt``) or min (``operator.lt``) of the last ``n`` values pushed,
+    kept in a monotonic deque."""
+
+    def __init__(self, n, better):
+        self.n = n
+        self.better = better
+        self.candidates = deque()
+        self.pushes = 0
+
+    def push(self, x):
+        while self.candidates and not self.better(self.candidates[-1][1], x):
+            self.candidates.pop()
+        self.candidates.append((self.pushes, x))
+        if self.candidates[0][0] <= self.pushes - self.n:
+            self.candidates.popleft()
+        self.pushes += 1
+        return self.value
+
+    @property
+    def value(self):
+        return self.candidates[0][1]
+
+
+class _WindowedEMA(object):
+    """``MACD._compute_EMA`` of the values pushed so far.
+
+    The weighted sum of the last ``n`` values is carried forward: decay it, add
+    the new value and drop the weight of the value leaving the window.
+    """
+
+    def __init__(self, n):
+        self.decay = 1.0 - 1.0 / (1.0 + (n - 1) / 2.0)
+        self.values = deque(maxlen=n)
+        self.weighted_sum = 0.0
+        self.weight = 0.0
+        self.pushes = 0
+
+    def push(self, x):
+        n = self.values.maxlen
+        self.weighted_sum = self.decay * self.weighted_sum + x
+        if len(self.values) == n:
+            self.weighted_sum -= self.decay ** n * self.values[0]
+        else:
+            self.weight = self.decay * self.weight + 1.0
+        self.values.append(x)
+        self.pushes += 1
+        if self.pushes % n == 0:
+            self.weighted_sum = sum(
+                self.decay ** k * value for k, value in enumerate(reversed(self.values))
+            )
+        return self.weighted_sum / self.weight
+
+
+class _RSIStream(object):
+    """``_compute_RSI`` of the closes pushed so far."""
+
+    def __init__(self, n):
+        self.n = n
+        self.up = _RollingSum(n)
+        self.down = _RollingSum(n)
+        self.close = None
+        self.days = 0
+
+    def push(self, close):
+        if self.close is not None:
+            diff = close - self.close
+            self.up.push(diff if diff > 0 else 0.0)
+            self.down.push(-diff if diff < 0 else 0.0)
+        self.close = close
+        self.days += 1
+        if self.days <= self.n or self.down.sum == 0:
+            return 100
+        return 100 - 100 / (1 + (self.up.sum / self.n) / (self.down.sum / self.n))
+
+
+_TOLERANCE = 1e-9
+
+
+def _gt(a, b):
+    """``a > b``, or None when ``a`` and ``b`` are equal up to rounding."""
+    if abs(a - b) <= _TOLERANCE * max(abs(a), abs(b), 1):
+        return None
+    return a > b
+
+
+def _all(*conditions):
+    if False in conditions:
+        return False
+    if None in conditions:
+        return None
+    return True
+
+
+def _decision(buy, sell):
+    if buy is None or (not buy and sell is None):
+        return None
+    return 1 if buy else -1 if sell else 0
+
+
+def _values(ts):
+    return np.ascontiguousarray(ts.values, dtype=float)
+
+
+def _windows(x, n):
+    """Read-only view of every length-``n`` window of ``x`` along the first axis."""
+    return as_strided(
+        x,
+        shape=(x.shape[0] - n + 1, n) + x.shape[1:],
+        strides=(x.strides[0],) + x.strides,
+        writeable=False,
+    )
+
+
+def _rolling(x, n, reduce):
+    """``reduce`` the window ``x[max(0, t - n + 1) : t + 1]`` of every day ``t``.
+
+    Like ``tdf.iloc[-n:]`` on a short history, the first ``n - 1`` windows are
+    truncated rather than padded. ``reduce`` gets a stack of windows on axis 1.
+    """
+    out = np.empty(x.shape)
+    for t in range(min(n - 1, len(x))):
+        out[t] = reduce(x[None, : t + 1])[0]
+    if len(x) >= n:
+        out[n - 1 :] = reduce(_windows(x, n))
+    return out
+
+
+def _mean(windows):
+    return windows.mean(axis=1)
+
+
+def _max(windows):
+    return windows.max(axis=1)
+
+
+def _min(windows):
+    return windows.min(axis=1)
+
+
+def _CCI(windows):
+    SMA = windows.mean(axis=1, keepdims=True)
+    MD = np.abs(windows - SMA).mean(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (windows[:, -1] - SMA[:, 0]) / (MD * 0.015)
+
+
+def _compute_EMA_series(close, n):
+    """``MACD._compute_EMA`` of every prefix of ``close``.
+
+    Runs the same recursion as pandas' ``ewm(span=n).mean()`` over all the
+    length-``n`` windows at once, one window position per step.
+    """
+    alpha = 1.0 / (1.0 + (n - 1) / 2.0)
+    today = np.arange(len(close))
+    start = np.maximum(today - n + 1, 0)
+    weighted = close[start]
+    old_wt = 1.0
+    for k in range(1, n):
+        active = (start + k <= today).reshape((-1,) + (1,) * (close.ndim - 1))
+        cur = close[np.minimum(start + k, today)]
+        old_wt *= 1.0 - alpha
+        update = active & (weighted != cur)
+        weighted = np.where(update, (old_wt * weighted + cur) / (old_wt + 1.0), weighted)
+        old_wt += 1.0
+    return weighted
+
+
+def _lag(x, i=1):
+    """``x`` shifted ``i`` days later, NaN where there is no earlier day."""
+    out = np.full(x.shape, np.nan)
+    if i < len(x):
+        out[i:] = x[: len(x) - i]
+    return out
+
+
+def _to_signal(buy, sell):
+    return np.where(buy, 1, np.where(sell, -1, 0)).astype(np.int8)
+
 
 if __name__ == "__main__":
     from experiment.util.data import read
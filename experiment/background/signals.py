@@ -0,0 +1,76 @@
+import sys
+
+sys.path.append(".")
+
+from collections import OrderedDict
+
+from experiment.util.config import SIGNAL_BANK_BYTES
+from experiment.util.instrument import INSTRUMENTS
+
+
+class SignalBank(object):
+    """Least-recently-used cache of rule decisions, bounded in memory.
+
+    A ``Panel`` banks the decisions of a rule on all its stocks under the rule
+    class, rule parameters, and the panel's histories and date range, so every
+    agent using an equal rule shares one array, across epochs and Market
+    windows too. Each process has its own bank.
+    """
+
+    def __init__(self, max_bytes: int = SIGNAL_BANK_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._signals = OrderedDict()
+
+    def fetch(self, key, compute):
+        """Array banked under ``key``, or ``compute()`` banked under it."""
+        signal = self._signals.get(key)
+        if signal is not None:
+            self.hits += 1
+            INSTRUMENTS.count("signals.hit")
+            self._signals.move_to_end(key)
+            return signal
+
+        self.misses += 1
+        INSTRUMENTS.count("signals.miss")
+        signal = compute()
+        signal.setflags(write=False)
+        self._signals[key] = signal
+        self.nbytes += signal.nbytes
+        while self.nbytes > self.max_bytes and self._signals:
+            _, evicted = self._signals.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        return signal
+
+    def items(self):
+        """Banked ``(key, series)`` pairs, e.g. to hand to worker processes."""
+        return list(self._signals.items())
+
+    def update(self, items):
+        """Bank the ``(key, series)`` pairs of another bank's ``items``."""
+        for key, signal in items:
+            if key not in self._signals:
+                signal.setflags(write=False)
+                self._signals[key] = signal
+                self.nbytes += signal.nbytes
+        while self.nbytes > self.max_bytes and self._signals:
+            _, evicted = self._signals.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        self._signals.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._signals)
+
+    def __repr__(self):
+        return (
+            f"{self.hits} hits, {self.misses} misses, "
+            + f"{len(self)} series in {self.nbytes / 2 ** 20:.1f} MiB"
+        )
+
+
+SIGNAL_BANK = SignalBank()
@@ -1,9 +1,54 @@
 import pandas as pd
 
 
+class TradingCalendar(object):
+    """Integer positions of the trading days of a chronological DatetimeIndex."""
+
+    def __init__(self, index: pd.DatetimeIndex):
+        self.index = index
+        self._positions = {day: i for i, day in enumerate(index)}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, day):
+        return day in self._positions
+
+    def position(self, day):
+        """Position of trading day ``day``, KeyError if there was no trading on it."""
+        return self._positions[day]
+
+    def next_day(self, position):
+        """Position of the trading day after ``position``."""
+        if position + 1 >= len(self):
+            raise IndexError(f"No trading day after {self.index[position]}.")
+        return position + 1
+
+    def after(self, day):
+        """Position of the first trading day strictly after ``day``, trading or not."""
+        if day in self._positions:
+            return self.next_day(self._positions[day])
+        return self.index.searchsorted(day, side="right")
+
+    def window_start(self, position, n):
+        """Position of the first day of the ``n``-day window ending at ``position``."""
+        return max(0, position - n + 1)
+
+    def bounds(self, start_date, end_date):
+        """Position of ``start_date`` and of the first trading day on or after ``end_date``."""
+        if end_date in self._positions:
+            end = self._positions[end_date]
+        else:
+            end = self.index.searchsorted(end_date)
+        return self.position(start_date), end
+
+
 class KnowsFullTdf(object):
+    @property
+    def calendar(self):
+        if "_calendar" not in self.__dict__:
+            self._calendar = TradingCalendar(self.full_tdf.index)
+        return self._calendar
+
     def _next_day(self, day):
-        day += pd.DateOffset(days=1)
-        while day not in self.full_tdf.index:
-            day += pd.DateOffset(days=1)
-        return day
+        return self.full_tdf.index[self.calendar.after(day)]
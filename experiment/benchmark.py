@@ -0,0 +1,385 @@
+import sys
+
+sys.path.append(".")
+
+import argparse
+import json
+import os
+import platform
+import time
+
+import numpy as np
+
+from experiment.background.agent import (
+    BenchmarkAgent,
+    GeneticAgent,
+    GeneticBitAgent,
+    GeneticComplexAgent,
+    GeneticRealAgent,
+    vote,
+)
+from experiment.background.decision import make_decision, make_decisions
+from experiment.background.market import Market
+from experiment.background.signals import SIGNAL_BANK
+from experiment.GA import BitEvolution, ComplexEvolution, RealEvolution
+from experiment.util.config import TRAIN_END, TRAIN_START, logger
+from experiment.util.data import CSVSource, get_source
+from experiment.util.files import atomic_write
+from experiment.util.synthetic import SyntheticSource
+
+OUTPUT = os.path.join(".", "results", "benchmark.json")
+BASELINE = os.path.join(".", "results", "benchmark-baseline.json")
+
+AGENTS = [GeneticBitAgent, GeneticRealAgent, GeneticComplexAgent]
+EVOLUTIONS = [
+    (GeneticBitAgent, BitEvolution),
+    (GeneticRealAgent, RealEvolution),
+    (GeneticComplexAgent, ComplexEvolution),
+]
+
+
+def run(
+    seed: int = 0,
+    populations=(10, 100),
+    universes=(1, 4),
+    evolve_populations=(100, 10000),
+    repeat: int = 3,
+    check_days: int = 40,
+    check_symbols: int = 4,
+    source=None,
+):
+    """Time the hot paths on the local data and check fast paths against reference code.
+
+    Every timing is the best of ``repeat`` runs, and each run draws its agents
+    from ``np.random.seed(seed)``, so two runs on the same machine time the
+    same work.
+
+    Args:
+        populations (tuple): Population sizes given to ``Market.evaluate``.
+        universes (tuple): Numbers of stocks in the evaluated Markets, capped by
+            the symbols available.
+        evolve_populations (tuple): Population sizes given to ``Evolution.evolve``.
+        check_days (int): Length of the trading window, ending at ``TRAIN_END``,
+            on which fast and day-by-day fitness are compared, see ``check``.
+        check_symbols (int): Number of stocks traded in that window.
+        source: Data source, by default ``data.get_source()``; every symbol is used.
+
+    Returns:
+        dict: ``timings`` in seconds by benchmark name, ``checks`` of fast
+            against reference results, and ``meta`` describing the run.
+    """
+    source = source or get_source()
+    symbols = source.symbols()
+    assert symbols, "No data to benchmark on, see pipeline/main.py or --synthetic."
+    timings = {}
+
+    def timeit(name, func, setup=None, repeat=repeat):
+        best = float("inf")
+        for _ in range(repeat):
+            np.random.seed(seed)
+            args = setup() if setup else ()
+            start = time.perf_counter()
+            func(*args)
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best
+        logger.info(f"Benchmark {name}: {best:.6f}s")
+
+    tdf = source.read(symbols[0])
+    sample = np.linspace(len(tdf) // 2, len(tdf) - 1, 10).astype(int)
+    for rule in GeneticAgent.RULES:
+        timeit(
+            f"rule.{rule.__name__}.decide_series", rule().decide_series, lambda: (tdf,)
+        )
+        timeit(
+            f"rule.{rule.__name__}.decide_x{len(sample)}",
+            lambda r: [r.decide(tdf.iloc[: t + 1]) for t in sample],
+            lambda: (rule(),),
+        )
+
+    market = Market(TRAIN_START, TRAIN_END, symbols[:1], processes=1, source=source)
+    for agent_class in AGENTS:
+        timeit(
+            f"stock.trade_by.{agent_class.__name__}",
+            market.stocks[0].trade_by,
+            lambda: _cold(agent_class()),
+        )
+
+    for universe in sorted({min(n, len(symbols)) for n in universes}):
+        market = Market(
+            TRAIN_START, TRAIN_END, symbols[:universe], processes=1, source=source
+        )
+        for agent_class in AGENTS:
+            for population in populations:
+                timeit(
+                    f"market.evaluate.{agent_class.__name__}.{population}x{universe}",
+                    market.evaluate,
+                    lambda: _cold([agent_class() for _ in range(population)]),
+                )
+
+    for agent_class, evolution_class in EVOLUTIONS:
+        for population in evolve_populations:
+            timeit(
+                f"evolution.evolve.{evolution_class.__name__}.{population}",
+                evolution_class(0.6, 0.75, 0.1).evolve,
+                lambda: (
+                    [agent_class() for _ in range(population)],
+                    np.random.random(population),
+                ),
+            )
+
+    return {
+        "meta": {
+            "seed": seed,
+            "repeat": repeat,
+            "source": repr(source),
+            "symbols": symbols,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "time": time.time(),
+        },
+        "timings": timings,
+        "checks": check(source, symbols[:check_symbols], seed, check_days),
+    }
+
+
+def check(source, symbols, seed=0, days=40, processes: int = 2):
+    """Fitness from ``Market.evaluate`` against the day-by-day reference loop.
+
+    One agent of each genetic type trades ``symbols`` of ``source`` over the
+    last ``days`` trading days they share up to ``TRAIN_END``. Their histories
+    go through ``GappedSource`` first, so the panel also holds a history
+    starting late and one with missing days. Each stock's reference revenue
+    comes from ``Stock.trade_by_day``, its benchmark's from ``BenchmarkAgent``
+    day by day. The same Market with ``processes`` workers must then give the
+    same fitness, from ``evaluate`` and from a ``race`` keeping every agent.
+    Last, see ``check_vote``.
+
+    Returns:
+        dict: Per check, both results and whether they are equal.
+    """
+    source = GappedSource(source)
+    index = source.read(symbols[0]).index
+    for symbol in symbols[1:]:
+        index = index.intersection(source.read(symbol).index)
+    end = index[min(index.searchsorted(TRAIN_END), len(index) - 2)]
+    start = index[max(0, index.get_loc(end) - days)]
+    market = Market(start, end, symbols, processes=1, source=source)
+    benchmarks = [
+        stock.trade_by_day(BenchmarkAgent(stock.symbol, source)) for stock in market.stocks
+    ]
+
+    np.random.seed(seed)
+    agents = [agent_class() for agent_class in AGENTS]
+    SIGNAL_BANK.clear()
+    fast = market.evaluate(agents)
+    result = {}
+    for agent, fitness in zip(agents, fast):
+        revenues = [stock.trade_by_day(agent) for stock in market.stocks]
+        reference = (np.array(revenues) / benchmarks).mean()
+        result[type(agent).__name__] = _compared(fitness, reference)
+    result["benchmark"] = _compared(market.benchmark, benchmarks)
+
+    with Market(start, end, symbols, processes=processes, source=source) as market:
+        SIGNAL_BANK.clear()
+        result[f"evaluate.processes.{processes}"] = _compared(market.evaluate(agents), fast)
+        SIGNAL_BANK.clear()
+        result["race"] = _compared(market.race(agents, len(agents))[0], fast)
+    result["vote"] = check_vote(seed)
+    return result
+
+
+def check_vote(seed=0, agents: int = 200, days: int = 100):
+    """Votes of a gene matrix on a whole signal matrix against the votes of each
+    agent on each day, as ``GeneticAgent.decide`` casts them.
+
+    Genes have one decimal, so that many votes nearly cancel, where the order
+    of the sum decides between a hold and a trade.
+
+    Returns:
+        dict: The number of decisions that differ, and whether there are none.
+    """
+    rng = np.random.RandomState(seed)
+    n = len(GeneticAgent.RULES)
+    signals = rng.randint(-1, 2, (n, days)).astype(np.int8)
+    genes = np.round(rng.random_sample((agents, n)) * 2, 1)
+    fast = make_decisions(vote(signals, genes))
+    reference = np.array(
+        [[make_decision(vote(signals[:, t : t + 1], gene)[0]) for t in range(days)] for gene in genes],
+        dtype=np.int8,
+    )
+    return _compared(np.sum(fast != reference), 0)
+
+
+def _compared(fast, reference):
+    fast, reference = np.array(fast, dtype=float), np.array(reference, dtype=float)
+    return {
+        "fast": fast.tolist(),
+        "reference": reference.tolist(),
+        "equal": bool((fast == reference).all()),
+    }
+
+
+class GappedSource(object):
+    """``source`` with every third history starting a quarter of the way in, and
+    every third from the second on missing every seventh day.
+
+    Markets on it hold all the kinds of panel columns, whatever the data.
+    """
+
+    def __init__(self, source):
+        self.source = source
+
+    def symbols(self):
+        return self.source.symbols()
+
+    def read(self, symbol):
+        df = self.source.read(symbol)
+        i = self.symbols().index(symbol)
+        if i % 3 == 1:
+            return df.iloc[len(df) // 4 :]
+        if i % 3 == 2:
+            return df.drop(df.index[10::7])
+        return df
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.source == self.source
+
+    def __hash__(self):
+        return hash((type(self), self.source))
+
+    def __repr__(self):
+        return f"GappedSource({self.source!r})"
+
+
+def drift(source, reduced, seed: int = 0, population: int = 100):
+    """Fitness drift of reduced-precision storage (see ``data.compact``).
+
+    The same agents of each genetic type are evaluated on the training window of
+    every symbol of ``source`` and of ``reduced``, the same data in reduced
+    precision.
+
+    Returns:
+        dict: Per agent type, the largest and mean absolute fitness difference and
+            the share of agents whose fitness changed at all; the share of
+            default-rule decisions that changed; and the memory of both Markets.
+    """
+    symbols = source.symbols()
+    markets = [
+        Market(TRAIN_START, TRAIN_END, symbols, processes=1, source=s)
+        for s in (source, reduced)
+    ]
+    result = {}
+    for agent_class in AGENTS:
+        np.random.seed(seed)
+        agents = [agent_class() for _ in range(population)]
+        full, low = [np.array(market.evaluate(agents)) for market in markets]
+        difference = np.abs(full - low)
+        result[agent_class.__name__] = {
+            "max": float(difference.max()),
+            "mean": float(difference.mean()),
+            "changed": float((difference > 0).mean()),
+        }
+    rules = GeneticBitAgent(np.zeros(len(GeneticAgent.RULES))).rules
+    result["signals_changed"] = float(
+        np.mean([(markets[0].panel.signals(r) != markets[1].panel.signals(r)).mean() for r in rules])
+    )
+    result["memory"] = {
+        "full": markets[0].memory(),
+        "reduced": markets[1].memory(),
+    }
+    return result
+
+
+def _cold(*args):
+    # Setup of a timing that should compute every signal again.
+    SIGNAL_BANK.clear()
+    return args
+
+
+def compare(result, baseline, tolerance: float = 0.25, min_delta: float = 1e-3):
+    """Benchmarks more than ``tolerance`` (relative) and ``min_delta`` seconds
+    slower than in ``baseline``, so timer noise on tiny benchmarks is ignored.
+
+    Returns:
+        dict: Name to (baseline seconds, current seconds) of each regression.
+    """
+    regressions = {}
+    for name, seconds in result["timings"].items():
+        before = baseline["timings"].get(name)
+        if before is not None and seconds > before * (1 + tolerance) + min_delta:
+            regressions[name] = (before, seconds)
+    return regressions
+
+
+def _save(path, result):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with atomic_write(path) as f:
+        json.dump(result, f, indent=1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline performance benchmarks.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=OUTPUT)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        default=0,
+        help="Benchmark on this many synthetic symbols instead of data/.",
+    )
+    parser.add_argument(
+        "--reduced",
+        action="store_true",
+        help="Benchmark on the data in reduced precision, see data.compact.",
+    )
+    parser.add_argument(
+        "--drift",
+        action="store_true",
+        help="Also measure the fitness drift of reduced precision.",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Also save the results as the baseline.",
+    )
+    args = parser.parse_args(argv)
+
+    if args.synthetic:
+        sources = [SyntheticSource(args.synthetic, seed=args.seed, reduced=r) for r in (False, True)]
+    else:
+        sources = [CSVSource(), CSVSource(reduced=True)]
+    result = run(seed=args.seed, repeat=args.repeat, source=sources[args.reduced])
+    # Fast paths are checked at both precisions, whichever one is timed.
+    other = sources[not args.reduced]
+    prefix = "reduced" if other.reduced else "full"
+    for name, c in check(other, other.symbols()[:4], args.seed).items():
+        result["checks"][f"{prefix}.{name}"] = c
+    if args.drift:
+        result["drift"] = drift(*sources, seed=args.seed)
+        logger.info(f"Reduced precision drift: {result['drift']}")
+    _save(args.output, result)
+    failed = [name for name, c in result["checks"].items() if not c["equal"]]
+    for name in failed:
+        logger.error(f"Check {name} failed: {result['checks'][name]}")
+
+    regressions = {}
+    if args.save_baseline:
+        _save(args.baseline, result)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["meta"].get("source") != result["meta"]["source"]:
+            logger.warning(f"Baseline ran on {baseline['meta'].get('source')}, not compared.")
+        else:
+            regressions = compare(result, baseline, args.tolerance)
+        for name, (before, after) in regressions.items():
+            logger.error(f"Regression {name}: {before:.6f}s -> {after:.6f}s")
+    return 1 if failed or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
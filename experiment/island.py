@@ -0,0 +1,186 @@
+import sys
+
+sys.path.append(".")
+
+from multiprocessing import Pipe, Process
+
+import numpy as np
+import pandas as pd
+
+from experiment import Experiment
+from experiment.background.market import Market
+from experiment.util.config import logger
+
+TOPOLOGIES = ["ring", "full"]
+
+
+class IslandExperiment(Experiment):
+    """``Experiment`` over several subpopulations, each evolving in its own process.
+
+    Every island has its own ``Evolution`` and only meets the others every
+    ``migration_interval`` epochs, when the ``migrants`` best agents of each
+    island replace the worst agents of its neighbours: the next island for a
+    "ring" topology, every other island for "full".
+
+    ``history`` has the usual best/avg rows over all islands together, and
+    ``island_histories`` one such frame per island.
+    """
+
+    def __init__(
+        self,
+        populations,
+        evolutions,
+        market,
+        migration_interval: int = 2,
+        migrants: int = 1,
+        topology: str = "ring",
+    ):
+        assert len(populations) == len(evolutions) > 1
+        assert migration_interval > 0
+        assert topology in TOPOLOGIES
+        super().__init__(
+            [agent for population in populations for agent in population],
+            evolutions[0],
+            market,
+        )
+        self.populations = populations
+        self.evolutions = evolutions
+        self.migration_interval = migration_interval
+        self.migrants = migrants
+        self.topology = topology
+
+    def train(self, epoch):
+        logger.info(
+            f"Island experiment start: {len(self.populations)} islands of "
+            + f"{[len(population) for population in self.populations]} agents, "
+            + f"{self.topology} migration of {self.migrants} every {self.migration_interval} epochs."
+        )
+        for evolution in self.evolutions:
+            logger.info(
+                f"Evolution: {str(type(evolution))}, with params: {evolution.get_params_str()}"
+            )
+        seeds = np.random.randint(0, 2 ** 31, len(self.populations))
+        islands = [
+            _Island(population, evolution, self.market.identity, seed)
+            for population, evolution, seed in zip(self.populations, self.evolutions, seeds)
+        ]
+        try:
+            results = [[] for _ in islands]
+            done = 0
+            while done < epoch:
+                n = min(self.migration_interval, epoch - done)
+                for rows, island_rows in zip(results, _ask(islands, "evolve", n)):
+                    rows.extend(island_rows)
+                done += n
+                logger.info(f"Islands reached epoch {done}/{epoch}.")
+                if done < epoch:
+                    self._migrate(islands)
+            finals = _ask(islands, "final")
+        finally:
+            for island in islands:
+                island.close()
+
+        self.populations = [final[0] for final in finals]
+        self.population = [agent for population in self.populations for agent in population]
+        self.train_eval = [fitness for final in finals for fitness in final[1]]
+        for rows, final in zip(results, finals):
+            rows.append([max(final[1]), np.mean(final[1]), len(final[1])])
+
+        self.island_histories = [
+            pd.DataFrame([row[:2] for row in rows], columns=["best", "avg"]) for rows in results
+        ]
+        result = []
+        for epoch_rows in zip(*results):
+            best, avg, size = np.array(epoch_rows).T
+            result.append([best.max(), (avg * size).sum() / size.sum()])
+        self.history = pd.DataFrame(result, columns=["best", "avg"])
+        logger.info(
+            f"Final population's best: {self.history.best.iloc[-1]}, average: {self.history.avg.iloc[-1]}"
+        )
+        return self.history
+
+    def _migrate(self, islands):
+        emigrants = _ask(islands, "emigrants", self.migrants)
+        n = len(islands)
+        for i, island in enumerate(islands):
+            if self.topology == "ring":
+                sources = [(i - 1) % n]
+            else:
+                sources = [j for j in range(n) if j != i]
+            island.send("immigrants", [agent for j in sources for agent in emigrants[j]])
+        for island in islands:
+            island.recv()
+
+
+class _Island(object):
+    def __init__(self, population, evolution, identity, seed):
+        self.conn, child = Pipe()
+        self.process = Process(
+            target=_island_worker,
+            args=(child, population, evolution, identity, seed),
+            daemon=True,
+        )
+        self.process.start()
+
+    def send(self, command, arg=None):
+        self.conn.send((command, arg))
+
+    def recv(self):
+        return self.conn.recv()
+
+    def close(self):
+        if self.process.is_alive():
+            self.send("stop")
+            self.process.join()
+
+
+def _ask(islands, command, arg=None):
+    for island in islands:
+        island.send(command, arg)
+    return [island.recv() for island in islands]
+
+
+def _island_worker(conn, population, evolution, identity, seed):
+    np.random.seed(seed)
+    start_date, end_date, all_symbols, source = identity
+    market = Market(start_date, end_date, list(all_symbols), processes=1, source=source)
+    experiment = Experiment(population, evolution, market)
+
+    def ranked():
+        evaluation = experiment.evaluate(population)
+        return [population[i] for i in np.argsort(evaluation)[::-1]], evaluation
+
+    while True:
+        command, arg = conn.recv()
+        if command == "evolve":
+            rows = []
+            for _ in range(arg):
+                evaluation = experiment.evaluate(population)
+                rows.append([max(evaluation), np.mean(evaluation), len(evaluation)])
+                population = evolution.evolve(population, evaluation)
+            conn.send(rows)
+        elif command == "emigrants":
+            conn.send(ranked()[0][:arg])
+        elif command == "immigrants":
+            immigrants = arg[: len(population) - 1]
+            population = ranked()[0][: len(population) - len(immigrants)] + immigrants
+            conn.send(None)
+        elif command == "final":
+            evaluation = experiment.evaluate(population)
+            conn.send((population, evaluation))
+        elif command == "stop":
+            break
+
+
+if __name__ == "__main__":
+    from experiment.background.agent import GeneticComplexAgent
+    from experiment.GA import ComplexEvolution
+    from experiment.util.config import TEST_END, TEST_START, TRAIN_END, TRAIN_START
+
+    populations = [[GeneticComplexAgent() for _ in range(10)] for _ in range(4)]
+    evolutions = [ComplexEvolution(0.6, 0.75, mutation) for mutation in [0.05, 0.1, 0.2, 0.3]]
+    e = IslandExperiment(populations, evolutions, Market(TRAIN_START, TRAIN_END, processes=1))
+    e.train(6)
+    with Market(TEST_START, TEST_END) as test_market:
+        e.test(test_market)
+    e.visualize()
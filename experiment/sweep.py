@@ -0,0 +1,147 @@
+import sys
+
+sys.path.append(".")
+
+import itertools
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from experiment import Experiment
+from experiment.background.agent import (
+    GeneticBitAgent,
+    GeneticComplexAgent,
+    GeneticRealAgent,
+)
+from experiment.background.market import Market
+from experiment.GA import BitEvolution, ComplexEvolution, RealEvolution
+from experiment.util.config import (
+    CORES,
+    TEST_END,
+    TEST_START,
+    TRAIN_END,
+    TRAIN_START,
+    logger,
+)
+from experiment.util.files import atomic_write
+
+AGENTS = {
+    "bit": (GeneticBitAgent, BitEvolution),
+    "real": (GeneticRealAgent, RealEvolution),
+    "complex": (GeneticComplexAgent, ComplexEvolution),
+}
+
+
+def grid(agents, evolution_params, populations, epochs, seeds=(None,)):
+    """Every combination of the given settings, one dict per run."""
+    return [
+        {
+            "agent": agent,
+            "evolution_params": list(params),
+            "population": population,
+            "epoch": epoch,
+            "seed": seed,
+        }
+        for agent, params, population, epoch, seed in itertools.product(
+            agents, evolution_params, populations, epochs, seeds
+        )
+    ]
+
+
+def run_key(run):
+    key = (
+        f"{run['agent']}-{run['population']}-agent-param-"
+        + f"{'-'.join([str(i) for i in run['evolution_params']])}-epoch-{run['epoch']}"
+    )
+    if run.get("seed") is not None:
+        key += f"-seed-{run['seed']}"
+    return key
+
+
+class ResultStore(object):
+    """One JSON file per finished run, named by ``run_key``, and the epoch
+    checkpoint of each unfinished one."""
+
+    def __init__(self, directory=os.path.join(".", "results", "sweep")):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, run):
+        return os.path.join(self.directory, run_key(run) + ".json")
+
+    def checkpoint(self, run):
+        return os.path.join(self.directory, run_key(run) + ".checkpoint.npz")
+
+    def __contains__(self, run):
+        return os.path.exists(self.path(run))
+
+    def save(self, run, result):
+        with atomic_write(self.path(run)) as f:
+            json.dump(result, f, indent=1)
+
+    def load(self, run):
+        with open(self.path(run), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+
+def sweep(runs, store=None, processes=CORES, visualize=True):
+    """Run every experiment not yet in ``store``, ``processes`` at a time.
+
+    Each worker builds the train and test Markets once and reuses them, with
+    their loaded data and signal bank, for every run it is given.
+
+    Returns:
+        list: Results of all ``runs``, in order, including those already stored.
+    """
+    store = store or ResultStore()
+    todo = [run for run in runs if run not in store]
+    logger.info(f"Sweep: {len(runs) - len(todo)} of {len(runs)} runs already stored.")
+    if not todo:
+        return [store.load(run) for run in runs]
+    with Pool(processes=processes, initializer=_init_worker) as pool:
+        for i, run in enumerate(
+            pool.imap_unordered(_run_worker, [(run, store, visualize) for run in todo])
+        ):
+            logger.info(f"Sweep: finished {run_key(run)} ({i + 1}/{len(todo)}).")
+    return [store.load(run) for run in runs]
+
+
+_markets = {}
+
+
+def _init_worker():
+    _markets["train"] = Market(TRAIN_START, TRAIN_END, processes=1)
+    _markets["test"] = Market(TEST_START, TEST_END, processes=1)
+
+
+def _run_worker(args):
+    run, store, visualize = args
+    if run.get("seed") is not None:
+        np.random.seed(run["seed"])
+    else:
+        # Forked workers inherit the same RNG state, unseeded runs must not share it.
+        np.random.seed()
+    agent_class, evolution_class = AGENTS[run["agent"]]
+    population = [agent_class() for _ in range(run["population"])]
+    evolution = evolution_class(*run["evolution_params"])
+    e = Experiment(population, evolution, _markets["train"])
+    e.train(run["epoch"], checkpoint=store.checkpoint(run))
+    e.test(_markets["test"])
+    store.save(
+        run,
+        {
+            **run,
+            "history": e.history.to_dict(orient="list"),
+            "train_eval": [float(i) for i in e.train_eval],
+            "test_max": float(e.test_max),
+            "test_mean": float(e.test_mean),
+        },
+    )
+    # Only written after an epoch, so there is none with ``epoch`` 0.
+    if os.path.exists(store.checkpoint(run)):
+        os.remove(store.checkpoint(run))
+    if visualize:
+        e.visualize(os.path.join(store.directory, run_key(run) + ".png"))
+    return run
@@ -15,3 +15,14 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 CORES = 4
+
+SIGNAL_BANK_BYTES = 256 * 2 ** 20
+DATA_REGISTRY_BYTES = 1024 * 2 ** 20
+# Benchmark revenues kept, one per stock and date range, see market.benchmark.
+BENCHMARK_CACHE_SIZE = 2 ** 16
+
+# Store prices as float32 and volumes as uint32 by default, see experiment.util.data.compact.
+REDUCED_PRECISION = False
+
+# Counters and timers of the hot paths, see experiment.util.instrument.
+INSTRUMENT = False
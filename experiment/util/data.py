@@ -1,22 +1,263 @@
+import sys
+
+sys.path.append(".")
+
 import glob
 import os
+from collections import OrderedDict
 
+import numpy as np
 import pandas as pd
 
+from experiment.util.config import DATA_REGISTRY_BYTES, REDUCED_PRECISION
+from experiment.util.files import atomic_write
+from experiment.util.instrument import INSTRUMENTS
+
+FIELDS = ["open", "high", "low", "close", "volume"]
+PRICES = ["open", "high", "low", "close"]
+DIRECTORY = os.path.join(".", "data")
+
+
+def read(symbol, start=None, end=None):
+    """Price history of ``symbol`` in chronological order, optionally cut to [start, end].
+
+    Histories are shared through ``REGISTRY``, so their arrays are read-only.
+    Histories in the binary store (see ``ingest``) are backed by its memory-mapped
+    columns, so processes reading the same symbol share the page cache.
+    """
+    return REGISTRY.get(symbol, start, end)
+
+
+class Registry(object):
+    """Process-wide store of price histories, loading each symbol only once.
+
+    Every caller gets the same frame (or a date-range view of it). Entries are
+    reloaded when the file behind them changes, and the least recently used
+    ones are dropped once the loaded frames exceed ``max_bytes``. ``reduced``
+    histories (see ``compact``) are stored apart from full-precision ones.
+    Each of ``listeners`` is called with the symbol of every dropped entry, so
+    that results computed from the history can be dropped along with it.
+    """
+
+    def __init__(self, max_bytes: int = DATA_REGISTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.listeners = []
+        self._frames = OrderedDict()
+
+    def get(self, symbol, start=None, end=None, reduced=False):
+        key = (symbol, reduced)
+        mtime = _source_mtime(symbol)
+        if key in self._frames and self._frames[key][0] == mtime:
+            self._frames.move_to_end(key)
+            df = self._frames[key][1]
+        else:
+            self._drop(key)
+            with INSTRUMENTS.timer("data.load"):
+                df = _load(symbol)
+                if reduced:
+                    df = compact(df)
+                df = _read_only(df)
+            self._frames[key] = (mtime, df)
+            self.nbytes += df.memory_usage().sum()
+            while self.nbytes > self.max_bytes and len(self._frames) > 1:
+                self._drop(next(iter(self._frames)))
+
+        if start is None and end is None:
+            return df
+        return df.loc[start:end]
+
+    def invalidate(self, symbol=None):
+        """Forget ``symbol``, or every symbol if None, so it is loaded again."""
+        for key in list(self._frames):
+            if symbol is None or key[0] == symbol:
+                self._drop(key)
+
+    def _drop(self, key):
+        if key in self._frames:
+            self.nbytes -= self._frames.pop(key)[1].memory_usage().sum()
+            for listener in self.listeners:
+                listener(key[0])
+
+    def __contains__(self, symbol):
+        return any(key[0] == symbol for key in self._frames)
+
+    def __len__(self):
+        return len(self._frames)
+
+
+def compact(df):
+    """``df`` stored in reduced precision: float32 prices and uint32 volumes.
+
+    This halves the memory of a history. Prices keep about 7 significant
+    digits, so cents are only exact below $10,000. Volumes that are not whole
+    or do not fit in a uint32 are stored as float32 instead. Rules still
+    compute in float64 (``rules._values``), and revenues and fitness ratios
+    still accumulate in float64 (``market.backtest``). The only drift left is
+    the rounding of the stored prices. It can flip a rule's decision on a
+    near tie, and it moves revenues by about 1e-6 of the prices.
+    ``benchmark.py --drift`` reports the fitness drift, the flipped decisions
+    and the memory of both precisions on the data at hand.
+    """
+    columns = {field: df[field].values.astype(np.float32) for field in PRICES}
+    volume = df["volume"].values
+    fits = len(volume) == 0 or (
+        volume.min() >= 0
+        and volume.max() <= np.iinfo(np.uint32).max
+        and (volume == np.round(volume)).all()
+    )
+    columns["volume"] = volume.astype(np.uint32 if fits else np.float32)
+    return pd.DataFrame(columns, index=df.index)
+
+
+def _read_only(df):
+    # Every caller of a symbol shares its frame: an edit in place would silently
+    # change every Market of the process, so the arrays refuse it, as banked
+    # signals do. One block per column, without copying.
+    columns = {}
+    for column in df.columns:
+        columns[column] = df[column].to_numpy()
+        columns[column].setflags(write=False)
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+def _load(symbol):
+    # From the binary store written by ``ingest`` when it is at least as new as
+    # the CSV, otherwise parsed from the CSV.
+    columns = read_columns(symbol)
+    if columns is None:
+        return _read_csv(symbol)
+    index = pd.DatetimeIndex(columns.pop("date").view("datetime64[ns]"), name="timestamp")
+    # One block per memory-mapped column, not a copy of them all in one block.
+    return pd.DataFrame(columns, index=index, copy=False)
+
+
+def _source_mtime(symbol):
+    return max(
+        os.path.getmtime(path) if os.path.exists(path) else 0
+        for path in [_csv_path(symbol), os.path.join(_store_dir(symbol), "date.npy")]
+    )
+
+
+def read_columns(symbol):
+    """Memory-mapped columns of ``symbol`` in the binary store, without copying.
+
+    Returns:
+        dict: ``date`` as int64 nanoseconds and one float64 array per field, or
+            None if the store is missing or older than the CSV.
+    """
+    directory = _store_dir(symbol)
+    date_path = os.path.join(directory, "date.npy")
+    csv_path = _csv_path(symbol)
+    if not os.path.exists(date_path) or (
+        os.path.exists(csv_path) and os.path.getmtime(csv_path) > os.path.getmtime(date_path)
+    ):
+        return None
+    columns = {
+        field: np.load(os.path.join(directory, f"{field}.npy"), mmap_mode="r")
+        for field in FIELDS
+    }
+    columns["date"] = np.load(date_path, mmap_mode="r")
+    return columns
+
+
+def ingest(symbol, directory=DIRECTORY):
+    """Convert ``data/{symbol}.csv`` to the columnar binary store under ``data/store``.
 
-def read(symbol):
-    path = os.path.join(".", "data", f"{symbol}.csv")
+    Every field is saved as one contiguous float64 array, the dates as an int64
+    array, all in chronological order.
+
+    Args:
+        directory (str): Where the CSV files are, instead of ``data``.
+    """
+    df = _read_csv(symbol, directory)
+    directory = _store_dir(symbol, directory)
+    os.makedirs(directory, exist_ok=True)
+    for field in FIELDS:
+        _save(os.path.join(directory, f"{field}.npy"), df[field].values.astype(np.float64))
+    # Written last: its modification time tells whether the store is complete and fresh.
+    dates = df.index.values.astype("datetime64[ns]").view(np.int64)
+    _save(os.path.join(directory, "date.npy"), dates)
+
+
+def ingest_all():
+    for symbol in ALL_SYMBOLS:
+        ingest(symbol)
+
+
+def _read_csv(symbol, directory=DIRECTORY):
+    path = _csv_path(symbol, directory)
     with open(path, "r", encoding="utf-8") as f:
         df = pd.read_csv(path, index_col=0)
     df.index = pd.to_datetime(df.index)
-    return df.iloc[::-1]
+    # Downloads are stored newest first, rows appended by updates oldest first.
+    return df.sort_index()
+
+
+def _csv_path(symbol, directory=DIRECTORY):
+    return os.path.join(directory, f"{symbol}.csv")
+
+
+def _store_dir(symbol, directory=DIRECTORY):
+    return os.path.join(directory, "store", symbol)
+
+
+def _save(path, arr):
+    with atomic_write(path, "wb") as f:
+        np.save(f, np.ascontiguousarray(arr))
+
+
+class CSVSource(object):
+    """Data source of the downloaded histories in ``data/``, shared through ``REGISTRY``.
+
+    A data source has ``symbols()``, the symbols it can provide, and
+    ``read(symbol)``, a frame shaped like ``read`` returns. Sources are
+    compared by value, as they are part of a ``Market``'s identity.
+
+    Args:
+        reduced (bool): Read histories in reduced precision, see ``compact``.
+    """
+
+    def __init__(self, reduced: bool = False):
+        self.reduced = reduced
+
+    def symbols(self):
+        return _csv_symbols()
+
+    def read(self, symbol):
+        return REGISTRY.get(symbol, reduced=self.reduced)
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.reduced == self.reduced
+
+    def __hash__(self):
+        return hash((type(self), self.reduced))
+
+    def __repr__(self):
+        return f"CSVSource(reduced={self.reduced})" if self.reduced else "CSVSource()"
+
+
+def _csv_symbols():
+    return [os.path.splitext(os.path.basename(f))[0] for f in glob.glob(r"data/*.csv")]
+
+
+def get_source():
+    """The data source of Markets, Stocks and BenchmarkAgents not given one."""
+    return _source[0]
+
+
+def set_source(source):
+    _source[0] = source
+
+
+ALL_SYMBOLS = _csv_symbols()
 
+REGISTRY = Registry()
 
-ALL_SYMBOLS = [
-    os.path.splitext(os.path.basename(f))[0] for f in glob.glob(r"data/*.csv")
-]
+_source = [CSVSource(REDUCED_PRECISION)]
 
 if __name__ == "__main__":
+    ingest_all()
     print(read("CMS").loc[: pd.Timestamp(year=2016, month=1, day=5)])
     print(read("CMS").iloc[:2])
     print(type(read("CMS").index[0]))
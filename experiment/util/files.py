@@ -0,0 +1,23 @@
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path, mode="w"):
+    """File object writing ``path`` in one step.
+
+    Everything goes to ``path + ".tmp"``, which replaces ``path`` once the block
+    ends, so readers in other processes never see a partial file. If the block
+    raises, the temporary file is removed and ``path`` is left as it was.
+
+    Args:
+        mode (str): "w" for UTF-8 text, "wb" for bytes.
+    """
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, mode, **({} if "b" in mode else {"encoding": "utf-8"})) as f:
+            yield f
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
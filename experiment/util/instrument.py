@@ -0,0 +1,112 @@
+import sys
+
+sys.path.append(".")
+
+import time
+from collections import defaultdict
+
+from experiment.util.config import INSTRUMENT
+
+
+class Instruments(object):
+    """Opt-in counters and timers for the hot paths.
+
+    While disabled, ``count`` returns at once and ``timer`` hands out a shared
+    no-op context, so instrumented code costs one attribute check. Each process
+    has its own instruments; ``Market`` merges those of its workers.
+    """
+
+    def __init__(self, enabled: bool = INSTRUMENT):
+        self.enabled = enabled
+        self.reset()
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+
+    def reset(self):
+        self.counts = defaultdict(int)
+        self.seconds = defaultdict(float)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counts[name] += n
+
+    def add_time(self, name, seconds):
+        if self.enabled:
+            self.counts[name] += 1
+            self.seconds[name] += seconds
+
+    def timer(self, *name):
+        """Context adding its elapsed time to ``name``, and one to its count.
+
+        The parts of ``name`` are only joined with dots while enabled.
+        """
+        return _Timer(self, ".".join(name)) if self.enabled else _NO_TIMER
+
+    def snapshot(self):
+        return {"counts": dict(self.counts), "seconds": dict(self.seconds)}
+
+    def merge(self, snapshot):
+        for name, n in snapshot["counts"].items():
+            self.counts[name] += n
+        for name, seconds in snapshot["seconds"].items():
+            self.seconds[name] += seconds
+
+    def since(self, snapshot):
+        """Counts and times accumulated after ``snapshot`` was taken."""
+        now = self.snapshot()
+        return {
+            kind: {
+                name: value - snapshot[kind].get(name, 0)
+                for name, value in values.items()
+                if value != snapshot[kind].get(name, 0)
+            }
+            for kind, values in now.items()
+        }
+
+    def __repr__(self):
+        return ", ".join(
+            f"{name}: {self.counts[name]} in {self.seconds[name]:.3f}s"
+            for name in sorted(self.seconds, key=self.seconds.get, reverse=True)
+        )
+
+
+class _Timer(object):
+    def __init__(self, instruments, name):
+        self.instruments = instruments
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instruments.add_time(self.name, time.perf_counter() - self.start)
+
+
+class _NoTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+INSTRUMENTS = Instruments()
+
+
+def instrumented_task(args):
+    """Run ``func(task)`` in a worker, timing how long the task waited in the queue.
+
+    ``args`` is ``(func, task, submitted)`` with ``submitted`` the ``time.time()``
+    of submission. Returns the result and the worker's counters for this task.
+    """
+    func, task, submitted = args
+    INSTRUMENTS.enable()
+    INSTRUMENTS.reset()
+    INSTRUMENTS.add_time("worker.queue", time.time() - submitted)
+    with INSTRUMENTS.timer("worker.task"):
+        result = func(task)
+    return result, INSTRUMENTS.snapshot()
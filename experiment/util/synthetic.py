@@ -0,0 +1,140 @@
+import sys
+
+sys.path.append(".")
+
+import zlib
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from experiment.util.data import FIELDS, compact
+
+
+def generate(
+    symbol: str,
+    start="1990-01-01",
+    end="2019-12-31",
+    seed: int = 0,
+    mu: float = 0.05,
+    sigma: float = 0.25,
+) -> pd.DataFrame:
+    """Synthetic daily OHLCV history of ``symbol``, shaped like ``data.read`` returns.
+
+    Closes follow a geometric Brownian motion with annual drift ``mu`` and a
+    volatility drawn around ``sigma``. Each open gaps slightly from the previous
+    close, highs and lows reach beyond the open and close by a random part of the
+    day's volatility, and volume grows with the size of the day's move. Prices
+    are in cents and volumes whole, as in the downloaded data. Trading days are
+    business days.
+
+    The history depends only on ``symbol``, ``seed`` and the other arguments, so
+    a symbol is the same whichever other symbols are generated with it.
+    """
+    index = _business_days(pd.Timestamp(start), pd.Timestamp(end))
+    n = len(index)
+    rng = np.random.default_rng([seed, zlib.crc32(symbol.encode())])
+
+    s0 = rng.uniform(10, 200)
+    vol = sigma * rng.uniform(0.5, 1.5) / np.sqrt(252)
+    z = rng.standard_normal((4, n))
+    close = s0 * np.exp(np.cumsum((mu / 252 - vol ** 2 / 2) + vol * z[0]))
+    gap = np.exp(0.2 * vol * z[1])
+    open_ = np.concatenate([[s0], close[:-1]]) * gap
+    high = np.maximum(open_, close) * np.exp(0.5 * vol * np.abs(z[2]))
+    low = np.minimum(open_, close) * np.exp(-0.5 * vol * np.abs(z[3]))
+
+    open_, high, low, close = [np.round(x, 2) for x in (open_, high, low, close)]
+    # Rounding must not move the open or close outside the day's range.
+    high = np.maximum.reduce([high, open_, close])
+    low = np.minimum.reduce([low, open_, close])
+
+    move = np.abs(np.log(close / np.concatenate([[s0], close[:-1]]))) / vol
+    volume = rng.uniform(1e5, 1e7) * rng.lognormal(0, 0.3, n) * (1 + move)
+    volume = np.round(volume).astype(np.int64)
+
+    columns = dict(zip(FIELDS, [open_, high, low, close, volume]))
+    return pd.DataFrame(columns, index=index)
+
+
+@lru_cache(maxsize=16)
+def _business_days(start, end):
+    # Same days as ``pd.bdate_range``, which is much slower over decades.
+    days = np.arange(
+        start.to_datetime64().astype("datetime64[D]"),
+        end.to_datetime64().astype("datetime64[D]") + 1,
+    )
+    return pd.DatetimeIndex(days[np.is_busday(days)].astype("datetime64[ns]"), name="timestamp")
+
+
+class SyntheticSource(object):
+    """Data source of ``generate``d histories, see ``data.CSVSource``.
+
+    Args:
+        symbols: Number of symbols, named ``S00000``, ``S00001``... or a list of names.
+        start, end: First and last (business) day of every history.
+        seed (int): Same seed, same histories.
+        reduced (bool): Histories in reduced precision, see ``data.compact``.
+    """
+
+    def __init__(
+        self,
+        symbols=100,
+        start="1990-01-01",
+        end="2019-12-31",
+        seed: int = 0,
+        mu: float = 0.05,
+        sigma: float = 0.25,
+        reduced: bool = False,
+    ):
+        if isinstance(symbols, int):
+            symbols = [f"S{i:05d}" for i in range(symbols)]
+        self._symbols = tuple(symbols)
+        self.start = pd.Timestamp(start)
+        self.end = pd.Timestamp(end)
+        self.seed = seed
+        self.mu = mu
+        self.sigma = sigma
+        self.reduced = reduced
+        # Hashed on every signal bank lookup, and the symbols may be thousands.
+        self._hash = hash(self._key())
+
+    def symbols(self):
+        return list(self._symbols)
+
+    def read(self, symbol):
+        df = generate(symbol, self.start, self.end, self.seed, self.mu, self.sigma)
+        return compact(df) if self.reduced else df
+
+    def _key(self):
+        return (
+            self._symbols,
+            self.start,
+            self.end,
+            self.seed,
+            self.mu,
+            self.sigma,
+            self.reduced,
+        )
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other._key() == self._key()
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        # Rebuilt rather than copied: string hashes differ between processes.
+        return (SyntheticSource, self._key())
+
+    def __repr__(self):
+        return (
+            f"SyntheticSource({len(self._symbols)} symbols, {self.start.date()} "
+            + f"to {self.end.date()}, seed={self.seed}"
+            + (", reduced)" if self.reduced else ")")
+        )
+
+
+if __name__ == "__main__":
+    print(generate("S00000").tail())
+    print(SyntheticSource(3).read("S00001").describe())
@@ -0,0 +1,162 @@
+import sys
+
+sys.path.append(".")
+
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from experiment import Experiment
+from experiment.background.agent import GeneticSimpleAgent
+from experiment.background.market import Market
+from experiment.background.signals import SIGNAL_BANK
+from experiment.util.config import CORES, logger
+
+COLUMNS = [
+    "train_start",
+    "train_end",
+    "test_start",
+    "test_end",
+    "train_best",
+    "train_avg",
+    "test_best",
+    "test_avg",
+]
+
+
+def rolling_windows(market, train_days, test_days, step=None, start=None, end=None):
+    """Consecutive walk-forward windows over the days every stock of ``market`` traded.
+
+    Each test window starts on the trading day after its train window ends, like
+    ``TEST_START`` after ``TRAIN_END``, and the windows move by ``step`` trading
+    days, by default ``test_days`` so that the test windows follow each other.
+
+    Args:
+        start, end: Only use the trading days between them. Rules still look back
+            before ``start``, as signals are computed over the full histories.
+
+    Returns:
+        list: ``(train_start, train_end, test_start, test_end)`` of every window.
+    """
+    days = market.trading_days()
+    days = days[(days >= (start or days[0])) & (days <= (end or days[-1]))]
+    step = step or test_days
+    return [
+        (days[i], days[i + train_days - 1], days[i + train_days], days[i + train_days + test_days - 1])
+        for i in range(0, len(days) - train_days - test_days + 1, step)
+    ]
+
+
+class WalkForward(object):
+    """Walk-forward validation: a new ``Experiment`` trained on each train window
+    and tested on the test window right after it.
+
+    Every window is a ``Market.window`` of ``market``, so the data is loaded once
+    and each rule's signals are computed once over the full histories, then
+    sliced by the windows. For simple agents the signals of the default rules
+    are computed up front and handed to every worker. Windows are independent
+    and run ``processes`` at a time, each from its own seed.
+
+    Args:
+        market (Market): Stocks to trade, whatever its own dates.
+        windows (list): ``(train_start, train_end, test_start, test_end)`` tuples,
+            e.g. from ``rolling_windows``.
+        n_population (int): Agents of ``agent_class`` trained in each window.
+    """
+
+    def __init__(
+        self,
+        market,
+        windows,
+        agent_class,
+        evolution,
+        n_population: int,
+        epoch: int,
+        processes: int = CORES,
+        racing: bool = False,
+    ):
+        assert windows
+        self.market = market
+        self.windows = windows
+        self.agent_class = agent_class
+        self.evolution = evolution
+        self.n_population = n_population
+        self.epoch = epoch
+        self.processes = processes
+        self.racing = racing
+
+    def run(self):
+        """Train and test every window.
+
+        Returns:
+            pd.DataFrame: One row per window, with its dates and the best and
+                average fitness of the final population on its train and test
+                windows. ``histories`` keeps each window's training history.
+        """
+        logger.info(
+            f"Walk-forward start: {len(self.windows)} windows of "
+            + f"{self.n_population} {self.agent_class.__name__}, {self.epoch} epochs."
+        )
+        if issubclass(self.agent_class, GeneticSimpleAgent):
+            for rule in self.agent_class(np.zeros(len(self.agent_class.RULES))).rules:
+                self.market.panel.signals(rule)
+        seeds = np.random.randint(0, 2 ** 31, len(self.windows))
+        tasks = [
+            (window, seed, self.agent_class, self.evolution, self.n_population, self.epoch, self.racing)
+            for window, seed in zip(self.windows, seeds)
+        ]
+        processes = min(self.processes, len(tasks))
+        if processes == 1:
+            _init_worker(self.market, [])
+            results = [_run_window(task) for task in tasks]
+        else:
+            with Pool(
+                processes=processes,
+                initializer=_init_worker,
+                initargs=(self.market, SIGNAL_BANK.items()),
+            ) as pool:
+                results = pool.map(_run_window, tasks)
+
+        self.histories = [history for _, history in results]
+        self.result = pd.DataFrame([row for row, _ in results], columns=COLUMNS)
+        logger.info(
+            f"Walk-forward test best: {self.result.test_best.mean()}, "
+            + f"average: {self.result.test_avg.mean()} over {len(self.windows)} windows."
+        )
+        return self.result
+
+
+_worker = {}
+
+
+def _init_worker(market, signals):
+    _worker["market"] = market
+    SIGNAL_BANK.update(signals)
+
+
+def _run_window(task):
+    window, seed, agent_class, evolution, n_population, epoch, racing = task
+    train_start, train_end, test_start, test_end = window
+    market = _worker["market"]
+    np.random.seed(seed)
+    population = [agent_class() for _ in range(n_population)]
+    e = Experiment(
+        population, evolution, market.window(train_start, train_end, 1), racing=racing
+    )
+    history = e.train(epoch)
+    e.test(market.window(test_start, test_end, 1))
+    row = [*window, history.best.iloc[-1], history.avg.iloc[-1], e.test_max, e.test_mean]
+    logger.info(f"Walk-forward window {train_start.date()} to {test_end.date()} done.")
+    return row, history
+
+
+if __name__ == "__main__":
+    from experiment.background.agent import GeneticBitAgent
+    from experiment.GA import BitEvolution
+    from experiment.util.config import TEST_END, TRAIN_START
+
+    market = Market(TRAIN_START, TEST_END, processes=1)
+    windows = rolling_windows(market, 250, 60, start=TRAIN_START)
+    walk = WalkForward(market, windows, GeneticBitAgent, BitEvolution(0.6, 0.75, 0.1), 15, 3)
+    print(walk.run())
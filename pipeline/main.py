@@ -1,57 +1,373 @@
+import inspect
+import json
 import os
 import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from io import StringIO
 
 import pandas as pd
 import requests
 from yaml import safe_load
 
+sys.path.append(".")
+
+from experiment.util.data import ingest
+from experiment.util.files import atomic_write
+
 API = "https://www.alphavantage.co/query"
+MANIFEST = os.path.join("data", "manifest.json")
+# Keyword of ``DataFrame.to_csv``, renamed from ``line_terminator`` in pandas 1.5.
+LINE_TERMINATOR = (
+    "lineterminator"
+    if "lineterminator" in inspect.signature(pd.DataFrame.to_csv).parameters
+    else "line_terminator"
+)
+
+
+@lru_cache()
+def load_key(path="config.yml"):
+    with open(path, "r", encoding="utf-8") as f:
+        return safe_load(f)["key"]
+
+
+@lru_cache()
+def load_symbol_list(path=r"pipeline/list.csv"):
+    with open(path, "r", encoding="utf-8") as f:
+        _raw_list = pd.read_csv(f, header=0, index_col=False)
+    return [i for i in _raw_list.iloc[:, 0] if "$" not in i]
+
+
+class RateLimiter(object):
+    """Token bucket shared by all download threads: ``rate`` requests per second
+    on average, at most ``burst`` at once."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Throttled(Exception):
+    """Note of the API that the request budget is spent, sent with status 200."""
+
+
+class Manifest(object):
+    """On-disk record of each symbol's download, so an interrupted run resumes."""
+
+    def __init__(self, path=MANIFEST):
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def done(self, symbol, until=None):
+        """Whether ``symbol`` was downloaded, or with ``until``, updated up to that day."""
+        entry = self.entries.get(symbol, {})
+        return entry.get("status") == "done" and (until is None or entry.get("until", "") >= until)
+
+    def record(self, symbol, **entry):
+        with self.lock:
+            self.entries[symbol] = entry
+            with atomic_write(self.path) as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+
+
+class Downloader(object):
+    """Concurrent, rate-limited and resumable download of daily price histories.
+
+    Args:
+        api (str): Query endpoint, e.g. a local server standing in for Alpha Vantage.
+        key (str): API key, read from ``config.yml`` if None.
+        rate (float): Request budget per second, shared by all workers.
+        workers (int): Number of concurrent downloads.
+        retries (int): Retries of a request failing on the network, a server error or
+            throttling, waiting ``backoff * 2 ** attempt`` seconds.
+        manifest (str): Path of the manifest recording finished symbols.
+        directory (str): Where the CSV files are saved.
+    """
+
+    def __init__(
+        self,
+        api=API,
+        key=None,
+        rate: float = 5 / 60,
+        burst: int = 1,
+        workers: int = 4,
+        retries: int = 4,
+        backoff: float = 2.0,
+        timeout: float = 30,
+        manifest=MANIFEST,
+        directory="data",
+    ):
+        self.api = api
+        self.key = key if key is not None else load_key()
+        self.limiter = RateLimiter(rate, burst)
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.manifest = Manifest(manifest)
+        self.directory = directory
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        # One session per thread, reusing its connections across requests.
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def fetch(self, symbol, outputsize="full", parse=None):
+        """``symbol``'s daily history CSV, retrying transient failures with backoff.
+
+        Client errors, error messages of the API and malformed responses are
+        raised at once: retrying them would only spend the request budget.
+
+        Args:
+            outputsize (str): "full" history, or "compact" for the latest 100 days.
+            parse (callable): Called as ``parse(header, lines)`` while the response
+                streams in, its result is returned. By default the CSV text.
+        """
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            try:
+                with self.session.get(
+                    self.api,
+                    params={
+                        "function": "TIME_SERIES_DAILY",
+                        "symbol": symbol,
+                        "outputsize": outputsize,
+                        "datatype": "csv",
+                        "apikey": self.key,
+                    },
+                    timeout=self.timeout,
+                    stream=True,
+                ) as r:
+                    r.raise_for_status()
+                    r.encoding = r.encoding or "utf-8"
+                    lines = r.iter_lines(decode_unicode=True)
+                    header = next(lines, "")
+                    if header.lstrip().startswith("{"):
+                        # Errors and throttling notes come back as JSON with status 200.
+                        body = " ".join([header, *lines])
+                        if "frequency" in body or "rate limit" in body.lower():
+                            raise Throttled(body)
+                        raise ValueError(body)
+                    if parse is None:
+                        return "\n".join([header, *lines])
+                    return parse(header, lines)
+            except requests.HTTPError as e:
+                status = e.response.status_code
+                if (status < 500 and status != 429) or attempt == self.retries:
+                    raise
+            except (requests.RequestException, Throttled):
+                if attempt == self.retries:
+                    raise
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def get_one_stock_history(
+        self, symbol, days=365 * 3, start_year=2016, start_month=1, start_day=1
+    ):
+        start = pd.Timestamp(start_year, start_month, start_day)
+        end = start + pd.DateOffset(days=days)
+        df = pd.read_csv(StringIO(self.fetch(symbol)), header=0, index_col=False)
+        df["timestamp"] = pd.to_datetime(df["timestamp"])
+        return df[(start <= df["timestamp"]) & (df["timestamp"] <= end)]
+
+    def save_one_stock_history(self, symbol, *args, **kwargs):
+        """Replace ``symbol``'s CSV by its downloaded history, see ``get_one_stock_history``.
+
+        The stored history is only replaced once the new one is completely written.
+        """
+        df = self.get_one_stock_history(symbol, *args, **kwargs)
+        with atomic_write(os.path.join(self.directory, symbol + ".csv")) as f:
+            df.to_csv(f, header=True, index=False, **{LINE_TERMINATOR: "\n"})
+        self.refresh_store(symbol)
+        return len(df)
+
+    def refresh_store(self, symbol):
+        """Ingest ``symbol`` again if it is in the binary store (see ``data.ingest``),
+        which is otherwise older than its CSV and ignored by ``data.read``."""
+        if os.path.exists(os.path.join(self.directory, "store", symbol)):
+            ingest(symbol, self.directory)
+
+    def last_stored_date(self, symbol):
+        """Latest date in ``symbol``'s CSV, or None if there is none.
+
+        Only the first and last lines are read: rows are stored newest first as
+        downloaded, then oldest first as appended by ``update_one_stock_history``.
+        A file without rows, or whose first or last row is cut short, has no
+        date either, so that it is downloaded again in full.
+        """
+        path = os.path.join(self.directory, symbol + ".csv")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            header = f.readline()
+            first = f.readline()
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 4096))
+            last = ([line for line in f.read().splitlines() if line.strip()] or [b""])[-1]
+        if not first.strip():
+            return None
+        dates = []
+        for line in [first, last]:
+            fields = line.strip().split(b",")
+            if len(fields) != len(header.split(b",")):
+                return None
+            try:
+                dates.append(pd.to_datetime(fields[0].decode(), format="%Y-%m-%d"))
+            except ValueError:
+                return None
+        return max(dates)
+
+    def update_one_stock_history(self, symbol, end=None):
+        """Append the days after the last stored one, up to ``end``, to ``symbol``'s CSV.
+
+        Only the compact (latest 100 days before today) output is requested when
+        it reaches back to the last stored day, and the full output if it turns
+        out not to. Rows are filtered while the response is parsed, and the
+        download stops at the first day already stored. Nothing is appended
+        unless the response reaches back to that day, so no gap is left behind.
+        The binary store of the symbol, if any, is refreshed. A history that already reaches the last weekday up to ``end`` costs no
+        request.
+
+        Returns:
+            int: Number of rows appended.
+        """
+        last = self.last_stored_date(symbol)
+        if last is None:
+            return self.save_one_stock_history(symbol)
+        end = _day(end)
+        if last >= pd.offsets.BDay().rollback(end):
+            return 0
+        after, until = last.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+        path = os.path.join(self.directory, symbol + ".csv")
+        with open(path, "r", encoding="utf-8") as f:
+            stored_header = f.readline().strip()
+
+        def parse(header, lines):
+            # Rows after the last stored day, and whether the response reached it.
+            if header.strip() != stored_header:
+                raise ValueError(f"Columns '{header}' do not match stored '{stored_header}'.")
+            rows = []
+            for line in lines:
+                if not line:
+                    continue
+                # Newest first, and ISO dates compare as strings.
+                date = line[:10]
+                if date <= after:
+                    return rows, True
+                if date <= until:
+                    rows.append(line)
+            return rows, False
+
+        # Compact output ends today, whatever ``end``; 100 trading days take
+        # about 140 calendar days.
+        outputsize = "compact" if (pd.Timestamp.today() - last).days < 140 else "full"
+        rows, complete = self.fetch(symbol, outputsize, parse)
+        if not complete and outputsize == "compact":
+            rows, complete = self.fetch(symbol, "full", parse)
+        if not complete:
+            raise ValueError(f"History of {symbol} does not reach back to {after}.")
+        with open(path, "a", encoding="utf-8") as f:
+            f.writelines(row + "\n" for row in reversed(rows))
+        if rows:
+            self.refresh_store(symbol)
+        return len(rows)
+
+    def download(self, symbols, *args, **kwargs):
+        """Save every symbol not yet done in the manifest, ``workers`` at a time.
+
+        Extra arguments go to ``get_one_stock_history``. Failures are recorded
+        in the manifest and retried on the next run.
+        """
+        todo = [symbol for symbol in symbols if not self.manifest.done(symbol)]
+        return self._run(self.save_one_stock_history, todo, *args, **kwargs)
+
+    def update(self, symbols, end=None):
+        """``update_one_stock_history`` of every symbol, ``workers`` at a time.
+
+        Symbols already up to date cost no request, nor do those the manifest
+        records as updated up to ``end``, so an interrupted update simply
+        resumes when run again.
+        """
+        until = _day(end).strftime("%Y-%m-%d")
+        todo = [symbol for symbol in symbols if not self.manifest.done(symbol, until)]
+        return self._run(self.update_one_stock_history, todo, end, entry={"until": until})
+
+    def _run(self, task, symbols, *args, entry=None, **kwargs):
+        # ``entry`` is added to the manifest record of every symbol done.
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(task, symbol, *args, **kwargs): symbol for symbol in symbols}
+            for future in as_completed(futures):
+                symbol = futures[future]
+                try:
+                    rows = future.result()
+                    self.manifest.record(
+                        symbol, status="done", rows=rows, time=time.time(), **(entry or {})
+                    )
+                except Exception as e:
+                    error = str(e).replace(self.key, "<key>")
+                    self.manifest.record(symbol, status="failed", error=error, time=time.time())
+                    print(f"{symbol} failed. Error:", error)
+        return self.manifest
 
-with open("config.yml", "r", encoding="utf-8") as f:
-    KEY = safe_load(f)["key"]
 
-with open(r"pipeline/list.csv", "r", encoding="utf-8") as f:
-    _raw_list = pd.read_csv(f, header=0, index_col=False)
-    SYMBOL_LIST = [i for i in _raw_list.iloc[:, 0] if "$" not in i]
+def _day(end):
+    # ``end``, today by default, without its time of day: stored dates are midnights.
+    return (pd.Timestamp.today() if end is None else pd.Timestamp(end)).normalize()
 
 
 def get_one_stock_history(
     symbol, days=365 * 3, start_year=2016, start_month=1, start_day=1
 ):
-    assert symbol in SYMBOL_LIST
-    r = requests.get(
-        API,
-        params={
-            "function": "TIME_SERIES_DAILY",
-            "symbol": symbol,
-            "outputsize": "full",
-            "datatype": "csv",
-            "apikey": KEY,
-        },
+    assert symbol in load_symbol_list()
+    return Downloader(retries=0).get_one_stock_history(
+        symbol, days, start_year, start_month, start_day
     )
-    start = pd.Timestamp(start_year, start_month, start_day)
-    end = start + pd.DateOffset(days=days)
-    df = pd.read_csv(StringIO(r.text), header=0, index_col=False)
-    df["timestamp"] = pd.to_datetime(df["timestamp"])
-    return df[(start <= df["timestamp"]) & (df["timestamp"] <= end)]
 
 
 def save_one_stock_history(
     symbol, days=365 * 3, start_year=2016, start_month=1, start_day=1
 ):
     try:
-        df = get_one_stock_history(symbol, days, start_year, start_month, start_day)
-        with open(os.path.join("data", symbol + ".csv"), "w", encoding="utf-8") as f:
-            df.to_csv(f, header=True, index=False, line_terminator="\n")
+        Downloader(retries=0).save_one_stock_history(
+            symbol, days, start_year, start_month, start_day
+        )
     except Exception as e:
         print(f"{symbol} failed. Error:", str(e))
 
 
 def get_random_symbol(n=5):
-    return random.sample(SYMBOL_LIST, n)
+    return random.sample(load_symbol_list(), n)
 
 
 if __name__ == "__main__":
-    for symbol in get_random_symbol():
-        save_one_stock_history(symbol)
+    if sys.argv[1:] == ["update"]:
+        Downloader().update(
+            [os.path.splitext(f)[0] for f in os.listdir("data") if f.endswith(".csv")]
+        )
+    else:
+        Downloader().download(get_random_symbol())